@@ -0,0 +1,98 @@
+"""
+Harness dùng chung cho các classification test script
+=====================================================
+
+test_json_classification.py và test_vn_simple.py chỉ khai báo CASES và gọi
+`run()`; phần classify đồng thời, ghi kết quả JSONL, tally và in kết quả nằm
+ở đây. Dưới pytest, `test_classify` được import vào từng script và conftest
+parametrize nó theo CASES của module đó.
+"""
+
+import os
+import sys
+import time
+import asyncio
+from collections import namedtuple
+
+import orjson
+
+try:
+    import pytest
+    # Không có API key: pytest skip cả module thay vì import google-genai
+    pytestmark = pytest.mark.skipif(
+        not os.getenv("GOOGLE_GENERATIVE_AI_API_KEY"), reason="no API key"
+    )
+except ImportError:
+    pytestmark = []
+
+Case = namedtuple('Case', 'subject body sender expected')
+
+# Kết quả từng case được append vào file JSONL để so sánh giữa các lần chạy
+RESULTS_PATH = os.getenv("CLASSIFY_RESULTS_PATH", "classify_results.jsonl")
+
+def _write_results(suite, cases, results):
+    run_at = time.time()
+    with open(RESULTS_PATH, "ab", buffering=64 * 1024) as f:
+        for case, result in zip(cases, results):
+            got = f"error: {result}" if isinstance(result, Exception) else result
+            f.write(orjson.dumps({
+                "suite": suite,
+                "run_at": run_at,
+                "case": case.subject,
+                "expected": case.expected,
+                "got": got,
+                "pass": got == case.expected,
+            }) + b"\n")
+
+async def _classify(case):
+    from src.services.genai_service import classify_email
+    return await asyncio.to_thread(classify_email, case.subject, case.body, case.sender)
+
+async def _classify_all(cases):
+    # Các Gemini call độc lập: chạy đồng thời, lỗi của từng case trả về như kết quả
+    return await asyncio.gather(*(_classify(c) for c in cases), return_exceptions=True)
+
+def test_classify(case):
+    """Một test case dưới pytest: label phải khớp expected (DB init bởi fixture `db`)"""
+    from src.services.genai_service import classify_email
+    assert classify_email(case.subject, case.body, case.sender) == case.expected
+
+def run(cases, suite, banner):
+    """
+    Chạy một bộ classification test case như script (không qua pytest)
+
+    Args:
+        cases: Tuple các Case
+        suite: Tên suite ghi vào RESULTS_PATH
+        banner: Dòng tiêu đề in ra trước khi chạy
+    """
+    print(banner)
+    print("=" * 60)
+
+    # classify_email cache kết quả Gemini trong SQLite (classification_cache):
+    # các lần chạy lại cùng test cases không gọi API nữa. CLASSIFY_NOCACHE=1 để bỏ qua.
+    from src.services.memory_store import init_db
+    init_db()
+
+    results = asyncio.run(_classify_all(cases))
+
+    _write_results(suite, cases, results)
+    passes = sum(r == c.expected for r, c in zip(results, cases))
+    numbered = list(enumerate(zip(cases, results), 1))
+    failures = [(i, (c, r)) for i, (c, r) in numbered if r != c.expected]
+
+    # Chỉ in chi tiết case fail (`-v` để in tất cả)
+    shown = numbered if "-v" in sys.argv else failures
+    for i, (test, result) in shown:
+        print(f"\n📧 Test {i}: {test.subject}")
+        print(f"From: {test.sender}")
+        print(f"Expected: {test.expected}")
+        if isinstance(result, Exception):
+            print(f"❌ ERROR: {result}")
+        else:
+            status = "✅ PASS" if result == test.expected else "❌ FAIL"
+            print(f"Result: {result} {status}")
+
+    print("\n" + "=" * 60)
+    print(f"\n📊 Passed: {passes}/{len(cases)} (chi tiết: {RESULTS_PATH})")
+    print("🎉 Test completed!")
@@ -0,0 +1,98 @@
+"""
+Pytest config cho các test script ở thư mục gốc
+===============================================
+
+Các file test_*.py vẫn chạy được trực tiếp bằng `python test_xxx.py`;
+conftest này cho phép chạy cùng các test đó qua pytest / pytest-xdist:
+
+    pytest -n auto --dist=loadfile
+
+- `-n auto` dùng max(1, cpu_count - 2) worker để chừa core cho API server
+- `--dist=loadfile` giữ các test cùng file (ví dụ test_api_server) trên một worker
+- Test có tham số `case` được parametrize theo `CASES` của module
+- Graph và database được khởi tạo một lần cho cả session (fixture `graph`, `db`)
+- Gemini client được khởi tạo trước khi các classification test chạy
+"""
+
+import functools
+import os
+import socket
+
+import pytest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Đánh dấu .env đã được load; xdist worker kế thừa environ từ process chính
+# nên thấy marker này và không parse lại file
+_DOTENV_MARKER = "AMBIENT_DOTENV_LOADED"
+
+@functools.lru_cache(maxsize=1)
+def _load_env():
+    """Load .env một lần cho cả session (không ghi đè biến đã set)"""
+    if os.environ.get(_DOTENV_MARKER):
+        return os.environ
+    try:
+        from dotenv import load_dotenv
+        load_dotenv(os.path.join(ROOT, ".env"), override=False)
+    except ImportError:
+        pass
+    os.environ[_DOTENV_MARKER] = "1"
+    return os.environ
+
+# Load ngay khi import conftest: pytestmark skipif của các test module được
+# evaluate lúc collection, trước mọi fixture
+_load_env()
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_xdist_auto_num_workers(config):
+    return max(1, (os.cpu_count() or 1) - 2)
+
+def pytest_terminal_summary(terminalreporter, exitstatus):
+    # Cùng khối TEST SUMMARY với runner của test_integration, một lần write;
+    # dưới xdist chỉ process chính có terminalreporter với report của mọi worker
+    from test_integration import summary_text
+    stats = terminalreporter.stats
+    passed = len(stats.get("passed", ()))
+    total = passed + sum(len(stats.get(k, ())) for k in ("failed", "error", "skipped"))
+    terminalreporter.write(summary_text(passed, total, exitstatus == 0))
+
+@pytest.fixture(scope="session", autouse=True)
+def env():
+    return _load_env()
+
+@pytest.fixture(scope="session")
+def graph():
+    from src.graph.build import build_graph
+    return build_graph()
+
+@pytest.fixture(scope="session", autouse=True)
+def db():
+    from src.services.memory_store import init_db
+    init_db()
+    yield
+
+@pytest.fixture(scope="session", autouse=True)
+def genai_warmup(request, db):
+    """
+    Trả trước chi phí khởi tạo Gemini cho các classification test (CASES)
+
+    google-genai 0.3.0 mở requests.Session mới cho mỗi request nên không có
+    connection pool để giữ ấm; không gọi API thật (tốn quota) mà chỉ import
+    SDK, tạo client và resolve DNS của API endpoint trước test đầu tiên.
+    """
+    if not os.getenv("GOOGLE_GENERATIVE_AI_API_KEY"):
+        return
+    if not any(hasattr(item.module, "CASES") for item in request.session.items):
+        return
+    try:
+        from src.services.genai_service import get_client
+        get_client()
+        socket.getaddrinfo("generativelanguage.googleapis.com", 443, proto=socket.IPPROTO_TCP)
+    except Exception:
+        # Warm-up best-effort: lỗi thật sẽ hiện ra ở test
+        pass
+
+def pytest_generate_tests(metafunc):
+    cases = getattr(metafunc.module, "CASES", None)
+    if cases is not None and "case" in metafunc.fixturenames:
+        metafunc.parametrize("case", cases, ids=[c.subject for c in cases])
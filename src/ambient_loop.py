@@ -10,32 +10,165 @@ Ambient Email Loop - Background Email Processing Worker
 
 Architecture:
 - Polling-based thay vì webhook (để tương thích free tier)
+- Incremental polling qua Gmail history API với historyId cursor
+- Cursor và stats lưu trong SQLite (ambient_state) để restart không xử lý lại INBOX
+- Cursor chỉ advance sau tick thành công (fetch + mọi POST); tick lỗi được lấy lại
+- Adaptive backoff: giãn interval khi inbox yên tĩnh, reset khi có email mới
 - Email filtering để giảm noise
 - HTTP requests đến API server
 - Error handling và retry logic
 """
 
-import os, time
+import logging, os, re, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 from src.services import gmail_service as gm
+from src.services import memory_store
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Load environment variables
 load_dotenv()
 
-# Configuration từ environment
-LABELS = [s.strip() for s in os.getenv("LABELS_TO_WATCH","INBOX").split(",")]
-POLL = int(os.getenv("POLL_INTERVAL_SECONDS","15"))
-API_BASE = (os.getenv("API_BASE","http://127.0.0.1:8000") or "").strip()
+@dataclass(frozen=True)
+class Config:
+    """
+    Cấu hình worker, đọc từ environment một lần khi import
+    
+    Attributes:
+        labels: Gmail labels cần theo dõi (LABELS_TO_WATCH)
+        poll_min: Polling interval sau khi có email mới (POLL_MIN_SECONDS)
+        poll_max: Polling interval tối đa khi inbox yên tĩnh (POLL_MAX_SECONDS)
+        api_base: URL của API server (API_BASE)
+        max_results: Số email tối đa khi quét lại INBOX (MAX_RESULTS)
+        process_concurrency: Số email xử lý song song mỗi tick (PROCESS_CONCURRENCY)
+        seen_capacity: Số message ID tối đa giữ trong bộ nhớ để dedup (SEEN_CAPACITY)
+        post_batch_size: Số email tối đa mỗi request POST /run-emails (POST_BATCH_SIZE)
+    """
+    labels: List[str]
+    poll_min: int
+    poll_max: int
+    api_base: str
+    max_results: int
+    process_concurrency: int
+    seen_capacity: int
+    post_batch_size: int
+
+    @property
+    def run_emails_url(self) -> str:
+        return f"{self.api_base.rstrip('/')}/run-emails"
+
+    @classmethod
+    def from_env(cls) -> "Config":
+        return cls(
+            labels=[s.strip() for s in os.getenv("LABELS_TO_WATCH","INBOX").split(",")],
+            poll_min=int(os.getenv("POLL_MIN_SECONDS","5")),
+            poll_max=int(os.getenv("POLL_MAX_SECONDS","300")),
+            api_base=(os.getenv("API_BASE","http://127.0.0.1:8000") or "").strip(),
+            max_results=int(os.getenv("MAX_RESULTS","20")),
+            process_concurrency=int(os.getenv("PROCESS_CONCURRENCY","10")),
+            seen_capacity=int(os.getenv("SEEN_CAPACITY","10000")),
+            post_batch_size=int(os.getenv("POST_BATCH_SIZE","16")),
+        )
+
+# Configuration từ environment (evaluate một lần)
+_CONFIG = Config.from_env()
+
+# Shared HTTP session: giữ keep-alive connection tới API server thay vì
+# mở TCP connection mới cho mỗi email
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=max(20, _CONFIG.process_concurrency),
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset({"GET", "POST"}),
+    ),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+def load_history_id() -> Optional[str]:
+    """
+    Đọc historyId cursor đã lưu từ lần chạy trước (bảng ambient_state)
+
+    Returns:
+        historyId dạng string, None nếu chưa có
+    """
+    return memory_store.get_ambient_state("history_id") or None
+
+def save_history_id(history_id: str):
+    """
+    Lưu historyId cursor vào SQLite để restart không scan lại INBOX
+
+    Chỉ gọi sau khi mọi email của tick đã được fetch và POST thành công,
+    nếu không email lỗi sẽ bị bỏ qua vĩnh viễn.
+
+    Args:
+        history_id: historyId mới nhất đã xử lý xong
+    """
+    memory_store.set_ambient_state("history_id", history_id)
+
+class LRUSet:
+    """
+    Set có giới hạn kích thước, evict phần tử ít được dùng nhất khi đầy
+    
+    Dùng cho dedup message IDs trong worker chạy lâu dài mà không để
+    bộ nhớ tăng vô hạn. Chỉ chứa ID đã xử lý xong (đã POST hoặc bị filter),
+    ID fetch/POST lỗi không được thêm để tick sau thử lại.
+    """
+
+    def __init__(self, cap: int):
+        self.d: OrderedDict = OrderedDict()
+        self.cap = cap
+
+    def __contains__(self, x) -> bool:
+        if x in self.d:
+            self.d.move_to_end(x)
+            return True
+        return False
+
+    def __len__(self) -> int:
+        return len(self.d)
+
+    def add(self, x):
+        self.d[x] = None
+        self.d.move_to_end(x)
+        if len(self.d) > self.cap:
+            self.d.popitem(last=False)
+
+    def update(self, items):
+        for x in items:
+            self.add(x)
+
+# Danh sách từ khóa spam/automated
+SPAM_INDICATORS = [
+    "unsubscribe", "no-reply", "noreply", "donotreply",
+    "automated", "auto-generated", "system notification",
+    "jobalerts-noreply", "newsletters", "marketing"
+]
+# Compile một lần: alternation match tất cả indicators trong một pass
+_SPAM_RE = re.compile("|".join(re.escape(s) for s in SPAM_INDICATORS), re.IGNORECASE)
+# Dấu hiệu link: một scan thay vì hai lần `in`
+_URL_HINT = re.compile(r"https?://|www\.")
 
 def should_process_email(subject: str, body: str, sender: str) -> bool:
     """
     Lọc email để quyết định có nên xử lý hay không
     
-    Logic filtering:
-    1. Skip email có spam indicators
-    2. Skip email quá ngắn (có thể là automated)
+    Logic filtering (check rẻ trước, scan body lớn sau cùng):
+    1. Skip email quá ngắn (có thể là automated)
+    2. Skip nếu sender/subject có spam indicators
     3. Skip email chỉ có links/images
+    4. Skip nếu body có spam indicators
     
     Args:
         subject: Tiêu đề email
@@ -45,59 +178,46 @@ def should_process_email(subject: str, body: str, sender: str) -> bool:
     Returns:
         True nếu nên xử lý email, False nếu skip
     """
-    # Danh sách từ khóa spam/automated
-    spam_indicators = [
-        "unsubscribe", "no-reply", "noreply", "donotreply",
-        "automated", "auto-generated", "system notification",
-        "jobalerts-noreply", "newsletters", "marketing"
-    ]
-    
-    text_to_check = f"{subject} {body} {sender}".lower()
+    b = body.strip()
     
-    # Skip nếu chứa spam indicators
-    if any(indicator in text_to_check for indicator in spam_indicators):
+    # Skip email quá ngắn (có thể là automated)
+    if len(b) < 50:
         return False
     
-    # Skip email quá ngắn (có thể là automated)
-    if len(body.strip()) < 50:
+    # Skip nếu sender/subject (ngắn) chứa spam indicators
+    if _SPAM_RE.search(sender) or _SPAM_RE.search(subject):
         return False
         
     # Skip email chỉ có links/images
-    if len(body.strip()) < 100 and ("http" in body or "www." in body):
+    if len(b) < 100 and _URL_HINT.search(b):
+        return False
+    
+    # Cuối cùng mới scan body (có thể rất dài), không concat/lower
+    if _SPAM_RE.search(b):
         return False
     
     return True
 
-def process_message(msg_id: str):
+def build_payload(msg_id: str, msg: dict) -> Optional[dict]:
     """
-    Xử lý một email message cụ thể
-    
-    Workflow:
-    1. Lấy message từ Gmail API
-    2. Extract subject, body, sender, recipient
-    3. Apply filtering logic
-    4. Gửi đến API server để xử lý qua LangGraph
+    Extract và lọc một email đã fetch, tạo payload cho API server
     
     Args:
-        msg_id: Gmail message ID cần xử lý
+        msg_id: Gmail message ID
+        msg: Gmail message dict (từ gm.get_message/get_messages_batch)
+        
+    Returns:
+        Payload dict cho /run-email(s), None nếu email bị filter
     """
-    # Lấy message từ Gmail API
-    msg = gm.get_message(msg_id)
-    if not msg:
-        print(f"Failed to get message {msg_id}")
-        return
-
     # Extract thông tin từ message
     subject, body, sender, recipient = gm.extract_subject_body(msg)
     
     # Apply filtering logic
     if not should_process_email(subject, body, sender):
         print(f"Skipped: {msg_id} - {subject[:50]}... (filtered out)")
-        # Note: Không thể increment skipped_count ở đây vì scope khác
-        return
+        return None
     
-    # Tạo payload để gửi đến API
-    payload = {
+    return {
         "user_id": "u_local",
         "email_id": msg_id,
         "email_subject": subject,
@@ -105,65 +225,175 @@ def process_message(msg_id: str):
         "email_sender": sender,
         "email_recipient": recipient
     }
+
+def post_email_batch(payloads: List[dict]) -> bool:
+    """
+    Gửi nhiều email đến API server trong một request POST /run-emails
+    
+    Server classify cả batch bằng ceil(N/CLASSIFY_BATCH_WINDOW) Gemini requests
+    thay vì mỗi email một request, rồi xử lý graph ở background.
     
+    Args:
+        payloads: List payload từ build_payload
+        
+    Returns:
+        True nếu server đã nhận batch, False nếu request lỗi hoặc non-2xx
+    """
+    url = _CONFIG.run_emails_url
     try:
-        # Gửi đến API server để HITL interrupts được capture trong UI queue
-        url = f"{API_BASE.rstrip('/')}/run-email"
-        res = requests.post(url, json=payload, timeout=30)
+        res = SESSION.post(url, data=orjson.dumps(payloads), headers=_JSON_HEADERS, timeout=30)
         if res.ok:
             data = res.json()
-            status = data.get("status")
-            print(f"Processed: {msg_id} - {status} (from: {sender})")
-        else:
-            print(f"API error {res.status_code} for {msg_id} -> {url}: {res.text}")
+            print(f"Queued batch of {len(payloads)} emails - job {data.get('job_id')}")
+            return True
+        print(f"API error {res.status_code} for batch of {len(payloads)} -> {url}: {res.text}")
     except (requests.RequestException, ValueError) as e:
-        print(f"Request error for {msg_id} -> {url}: {e}")
+        print(f"Request error for batch of {len(payloads)} -> {url}: {e}")
+    return False
+
+def list_new_message_ids(start_history_id: str) -> tuple[List[str], Optional[str]]:
+    """
+    Lấy message IDs mới của mọi label trong LABELS_TO_WATCH kể từ cursor
+    
+    Gmail history.list chỉ filter theo một labelId, nên query một lần cho mỗi
+    label rồi gộp lại (giữ thứ tự, bỏ trùng: email có cả INBOX và IMPORTANT).
+    
+    Args:
+        start_history_id: historyId cursor từ lần poll trước
+        
+    Returns:
+        Tuple (message_ids, next_history_id):
+        - next_history_id là cursor nhỏ nhất trong các label, nên label bị lỗi
+          (trả về cursor cũ) giữ cả tick lại để lần sau lấy lại
+        - next_history_id là None nếu cursor đã hết hạn, caller cần seed lại
+    """
+    ids: Dict[str, None] = {}
+    next_ids = []
+    for label in _CONFIG.labels:
+        label_ids, label_next = gm.list_history_message_ids(start_history_id, label)
+        if label_next is None:
+            return [], None
+        ids.update(dict.fromkeys(label_ids))
+        next_ids.append(label_next)
+    return list(ids), min(next_ids, key=int, default=start_history_id)
+
+def list_recent_message_ids() -> List[str]:
+    """
+    Một trang message IDs gần nhất của mỗi label (dùng khi seed lại cursor)
+    
+    messages.list với nhiều labelIds chỉ trả về email có đủ tất cả label,
+    nên cũng query riêng từng label rồi gộp lại.
+    """
+    ids: Dict[str, None] = {}
+    for label in _CONFIG.labels:
+        ids.update(dict.fromkeys(gm.list_recent_messages([label], max_results=_CONFIG.max_results)))
+    return list(ids)
 
 if __name__ == "__main__":
     """
     Main loop cho background email processing worker
     
     Workflow:
-    1. Khởi tạo tracking variables
-    2. Poll Gmail API mỗi POLL seconds
+    1. Khởi tạo tracking variables, historyId cursor và stats (từ SQLite hoặc Gmail profile)
+    2. Poll Gmail history API (mỗi label trong LABELS_TO_WATCH) để lấy message IDs mới kể từ cursor
     3. Lọc email mới chưa xử lý
-    4. Process từng email qua process_message()
-    5. Log statistics và continue loop
-    6. Handle errors gracefully và continue running
+    4. Batch fetch email mới, lọc qua build_payload() và POST theo batch đến /run-emails
+    5. Chỉ khi fetch và mọi POST thành công mới advance và lưu cursor; email đã
+       xử lý xong (đã POST hoặc bị filter) vào `seen`, email lỗi được thử lại tick sau
+    6. Lưu stats, điều chỉnh sleep interval (adaptive backoff) và continue loop
+    7. Handle errors gracefully và continue running
     """
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    memory_store.init_db()
+
     # Tracking variables
-    seen = set()  # Set các message ID đã xử lý
-    processed_count = 0  # Số email đã process
-    skipped_count = 0  # Số email đã skip (không được track chính xác)
+    seen = LRUSet(_CONFIG.seen_capacity)  # Các message ID đã xử lý gần đây (bounded)
+    processed_count = int(memory_store.get_ambient_state("processed_count", "0"))  # Số email đã process (qua các lần restart)
+    skipped_count = 0  # Số email đã bị filter trong lần chạy này
+    sleep_s = _CONFIG.poll_min  # Interval hiện tại, giãn dần khi không có email mới
+    last_history_id = load_history_id() or gm.get_history_id()
     
     print("🤖 Starting email processing loop...")
-    print(f"📧 Polling every {POLL} seconds for up to 20 emails per batch")
-    print(f"🏷️  Watching labels: {LABELS}")
+    print(f"📧 Polling every {_CONFIG.poll_min}-{_CONFIG.poll_max} seconds (adaptive backoff)")
+    print(f"🏷️  Watching labels: {_CONFIG.labels}")
+    print(f"🔖 Starting from historyId: {last_history_id}")
     print("=" * 60)
     
+    executor = ThreadPoolExecutor(max_workers=_CONFIG.process_concurrency, thread_name_prefix="ambient")
     while True:
         try:
-            # Lấy danh sách message IDs từ Gmail
-            ids = gm.list_recent_messages(LABELS, max_results=20)
+            # Cursor mới chỉ được nhận sau khi cả tick thành công; tick lỗi (kể cả
+            # exception giữa chừng) giữ cursor cũ để lần sau lấy lại đúng các email đó
+            if last_history_id is None:
+                # Chưa có cursor (Gmail lỗi lúc khởi động), thử seed lại
+                next_history_id = gm.get_history_id()
+                ids = []
+            else:
+                # Lấy danh sách message IDs mới từ Gmail history
+                ids, next_history_id = list_new_message_ids(last_history_id)
+                if next_history_id is None:
+                    # Cursor hết hạn: seed lại và quét một trang gần nhất để không bỏ sót
+                    print("⚠️ History cursor expired, re-seeding...")
+                    next_history_id = gm.get_history_id()
+                    ids = list_recent_message_ids()
             new_emails = [mid for mid in ids if mid not in seen]
+            tick_ok = True
             
             if new_emails:
                 print(f"\n📬 Found {len(new_emails)} new emails to process...")
                 
-                # Process từng email mới
+                # Fetch tất cả email mới trong một batch request
+                msgs = gm.get_messages_batch(new_emails)
                 for mid in new_emails:
-                    seen.add(mid)
-                    process_message(mid)
-                    processed_count += 1
+                    if mid not in msgs:
+                        print(f"Failed to get message {mid}")
+                        tick_ok = False
+                
+                # Lọc rồi gom thành các batch, POST song song đến /run-emails
+                payloads = []
+                for mid, msg in msgs.items():
+                    payload = build_payload(mid, msg)
+                    if payload:
+                        payloads.append(payload)
+                    else:
+                        # Bị filter: đã xử lý xong, không fetch lại
+                        skipped_count += 1
+                        seen.add(mid)
+                batches = [payloads[i:i + _CONFIG.post_batch_size] for i in range(0, len(payloads), _CONFIG.post_batch_size)]
+                for batch, ok in zip(batches, executor.map(post_email_batch, batches)):
+                    if ok:
+                        # Chỉ đếm/đánh dấu email server đã nhận
+                        processed_count += len(batch)
+                        seen.update(p["email_id"] for p in batch)
+                    else:
+                        tick_ok = False
                     
                 print(f"📊 Stats: Processed={processed_count}, Skipped={skipped_count}, Total seen={len(seen)}")
+                memory_store.set_ambient_state("processed_count", processed_count)
+                # Có activity: quay về interval ngắn nhất
+                sleep_s = _CONFIG.poll_min
+            else:
+                # Inbox yên tĩnh: giãn interval theo cấp số nhân
+                sleep_s = min(_CONFIG.poll_max, sleep_s * 2)
+                print(f"⏳ No new emails found, waiting {sleep_s}s...")
+            
+            if tick_ok:
+                if next_history_id:
+                    last_history_id = next_history_id
+                    save_history_id(last_history_id)
             else:
-                print(f"⏳ No new emails found, waiting {POLL}s...")
+                print("⚠️ Some emails failed, keeping history cursor to retry them")
+                sleep_s = min(_CONFIG.poll_max, sleep_s * 2)
                 
         except (KeyboardInterrupt, SystemExit):
             print("\n🛑 Shutting down email processor...")
+            executor.shutdown(wait=True)
             break
         except (ValueError, OSError, RuntimeError) as e:
             print(f"❌ Loop error: {e}")
             # Continue running even if there's an error
-        time.sleep(POLL)
+            sleep_s = min(_CONFIG.poll_max, sleep_s * 2)
+        time.sleep(sleep_s)
@@ -3,52 +3,134 @@ Ambient Email Agent - FastAPI Application
 ========================================
 
 Đây là file chính của ứng dụng FastAPI, cung cấp các API endpoints cho:
-- Xử lý email thông qua LangGraph workflow
+- Xử lý email thông qua LangGraph workflow (background jobs)
 - Human-in-the-Loop (HITL) approval system
 - Dashboard web interface cho quản lý email pending
 
 Architecture:
 - FastAPI server với static file serving
 - LangGraph integration với memory checkpointing
-- In-memory queue cho pending approvals
+- SQLite-backed queue cho pending approvals (pending_store)
 - RESTful API cho email processing và approval
 """
 
 import os
+import hmac
+import time
+import asyncio
 import logging
-from fastapi import FastAPI, Request, HTTPException
+import functools
+import itertools
+from fastapi import FastAPI, Request, HTTPException, Query, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, FileResponse, ORJSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
-from typing import Dict
-from pydantic import BaseModel, Field
+from typing import Dict, List
+import orjson
+from pydantic import BaseModel, ConfigDict, Field
 
-from langgraph.checkpoint.memory import MemorySaver
-from .graph.build import build_graph
 from .services.memory_store import init_db
-from .services.gmail_service import extract_sender_email
+from .services import pending_store
 from .services import gmail_service as gm
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
-
 # Load environment variables
 load_dotenv()
 
+# Configure logging (một lần cho process; library modules chỉ getLogger)
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+logger = logging.getLogger(__name__)
+
+# HITL secret đọc một lần lúc startup (bytes cho hmac.compare_digest)
+_HITL_SECRET = (os.getenv("HITL_SECRET") or "").encode()
+
 # Initialize FastAPI application
-app = FastAPI(title="Ambient Email Agent")
+app = FastAPI(title="Ambient Email Agent", default_response_class=ORJSONResponse)
 
 # Mount static files for web dashboard
 app.mount("/static", StaticFiles(directory="src/web"), name="static")
 
-# Initialize LangGraph with memory checkpointing
-checkpointer = MemorySaver()
-graph = build_graph().with_config(checkpointer=checkpointer)
+@functools.lru_cache(maxsize=1)
+def get_graph():
+    """
+    Build và compile LangGraph (memory checkpointing) một lần cho mỗi process
+    
+    Import graph/nodes lazy để import app (health check, tests) không phải
+    load LangGraph và LLM client libs.
+    
+    Returns:
+        Compiled LangGraph ready để execute
+    """
+    from langgraph.checkpoint.memory import MemorySaver
+    from .graph.build import build_graph
+    return build_graph().with_config(checkpointer=MemorySaver())
+
+# Draft đang được stream từ Gemini, theo email_id (xóa khi job xong). Chỉ sửa
+# trên event loop thread; _drafts_rev tăng mỗi lần đổi để /pending/stream đẩy
+# event "drafts" cho dashboard
+_drafts_in_progress: Dict[str, str] = {}
+_drafts_rev = 0
+
+# Số email tối đa gộp vào một Gemini classification request
+CLASSIFY_BATCH_WINDOW = int(os.getenv("CLASSIFY_BATCH_WINDOW", "16"))
+# Số email của một batch job chạy graph đồng thời tối đa
+GRAPH_MAX_CONCURRENCY = int(os.getenv("GRAPH_MAX_CONCURRENCY", "16"))
+
+# Pending queue change notification cho /pending/stream (SSE)
+PENDING_STREAM_RECHECK_SECONDS = float(os.getenv("PENDING_STREAM_RECHECK_SECONDS", "5"))
+_pending_loop: asyncio.AbstractEventLoop | None = None
+_pending_updated: asyncio.Event | None = None
+
+def _pending_updated_event() -> asyncio.Event:
+    """
+    Lấy Event của generation hiện tại (chỉ gọi trên event loop thread)
+    """
+    global _pending_updated
+    if _pending_updated is None:
+        _pending_updated = asyncio.Event()
+    return _pending_updated
+
+def _signal_pending_updated():
+    """
+    Đánh thức mọi stream đang chờ và bắt đầu generation mới
+    """
+    global _pending_updated
+    previous, _pending_updated = _pending_updated, asyncio.Event()
+    if previous is not None:
+        previous.set()
 
-# In-memory queue for pending HITL approvals
-# Key: thread_id, Value: interrupt payload with metadata
-PENDING: Dict[str, Dict] = {}
+def _notify_pending():
+    """
+    Listener của pending_store, có thể được gọi từ background threads
+    """
+    if _pending_loop is not None:
+        _pending_loop.call_soon_threadsafe(_signal_pending_updated)
+
+pending_store.add_listener(_notify_pending)
+
+def _set_draft(email_id: str, text: str | None):
+    """
+    Cập nhật (hoặc xóa nếu text là None) partial draft và đánh thức các SSE stream
+    """
+    global _drafts_rev
+    if text is None:
+        if _drafts_in_progress.pop(email_id, None) is None:
+            return
+    else:
+        _drafts_in_progress[email_id] = text
+    _drafts_rev += 1
+    _signal_pending_updated()
+
+# Sequence cho job IDs: rẻ hơn uuid4 (không cần os.urandom mỗi lần)
+_TID_SEQ = itertools.count()
+
+def _short_id() -> str:
+    """
+    Tạo ID ngắn, duy nhất trong process: monotonic ns + sequence (hex)
+    """
+    return f"{time.monotonic_ns():x}{next(_TID_SEQ):x}"
 
 
 class RunEmailRequest(BaseModel):
@@ -63,6 +145,8 @@ class RunEmailRequest(BaseModel):
         email_sender: Địa chỉ người gửi
         email_recipient: Địa chỉ người nhận (optional)
     """
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     user_id: str = Field(..., description="User identifier")
     email_id: str = Field(..., description="Gmail message id or local id")
     email_subject: str
@@ -80,6 +164,8 @@ class ApproveRequest(BaseModel):
         approved: True nếu approve, False nếu deny
         edits: Dictionary chứa các chỉnh sửa (to, subject, body)
     """
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
     thread_id: str
     approved: bool = True
     edits: Dict[str, str] | None = None
@@ -87,21 +173,32 @@ class ApproveRequest(BaseModel):
 @app.on_event("startup")
 def _startup():
     """
-    Khởi tạo database khi server startup
+    Khởi tạo database và warm graph cache khi server startup
     Tạo các bảng cần thiết cho memory store
     """
     init_db()
+    get_graph()
 
 @app.get("/", response_class=HTMLResponse)
-def home():
+def home(req: Request):
     """
     Trả về trang web dashboard chính
     
+    FileResponse set ETag/Last-Modified từ file stat; nếu browser gửi
+    If-None-Match khớp thì trả 304 Not Modified, không gửi lại body.
+    
+    Args:
+        req: FastAPI Request object (để lấy conditional headers)
+    
     Returns:
-        HTML content của dashboard HITL
+        FileResponse cho dashboard HITL, hoặc 304 response
     """
-    with open("src/web/index.html","r",encoding="utf-8") as f:
-        return f.read()
+    path = "src/web/index.html"
+    resp = FileResponse(path, media_type="text/html", stat_result=os.stat(path))
+    etag = resp.headers.get("etag")
+    if etag and req.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"etag": etag})
+    return resp
 
 @app.get("/health")
 def health() -> Dict[str, str]:
@@ -113,123 +210,311 @@ def health() -> Dict[str, str]:
     """
     return {"status": "ok"}
 
+@app.get("/stats")
+def stats() -> Dict[str, Dict[str, int]]:
+    """
+    Thống kê runtime của worker
+    
+    Returns:
+        Dict với "pre_classify": số email đã xét và số email bỏ qua Gemini theo label
+    """
+    from .services.genai_service import pre_classify_stats  # lazy như get_graph
+    return {"pre_classify": pre_classify_stats()}
 
-@app.post("/run-email")
-async def run_email(item: RunEmailRequest):
+
+@app.post("/run-email", status_code=202)
+async def run_email(item: RunEmailRequest, background_tasks: BackgroundTasks):
     """
-    Xử lý email thông qua LangGraph workflow
+    Nhận email và đưa vào background job để xử lý qua LangGraph
+    
+    Request trả về ngay (202 Accepted) thay vì chờ LLM, nên ambient worker
+    không bị serialize theo latency của graph và event loop vẫn rảnh cho
+    /pending và /approve. Kết quả cần approval xuất hiện qua /pending.
+    
+    Args:
+        item: RunEmailRequest chứa thông tin email
+        background_tasks: FastAPI BackgroundTasks để chạy job sau response
+        
+    Returns:
+        Dict với status "QUEUED" và job_id
+    """
+    job_id = _short_id()
+    background_tasks.add_task(_process_job, item.model_dump(), job_id)
+    logger.info("Queued email %s as job %s", item.email_id, job_id)
+    return {"status": "QUEUED", "job_id": job_id}
+
+def _queue_approval(thread_id: str, hitl: Dict, state: Dict):
+    """
+    Lưu HITL payload vào pending queue kèm metadata cho UI filtering
+    """
+    pending_store.put(thread_id, {
+        "thread_id": thread_id,
+        "value": hitl,
+        "triage": state.get("triage"),
+        "priority": state.get("priority"),
+        "is_vip": state.get("is_vip"),
+    })
+
+async def _process_job(payload: Dict, job_id: str) -> Dict:
+    """
+    Xử lý email thông qua LangGraph workflow (background task trên event loop)
+    
+    Graph chạy async (astream) nên các job đang chờ Gemini không chiếm thread,
+    nhiều email được xử lý đồng thời.
     
     Workflow:
     1. Nhận email data từ request
     2. Chạy qua LangGraph pipeline (triage -> agent -> sensitive)
-    3. Nếu cần approval, tạo interrupt và lưu vào PENDING queue
+    3. Nếu cần approval, tạo interrupt và lưu vào pending queue
     4. Trả về status và thread_id cho HITL
     
     Args:
-        item: RunEmailRequest chứa thông tin email
+        payload: Email data từ RunEmailRequest
+        job_id: ID của background job (để log)
         
     Returns:
         Dict với status và thông tin cần thiết:
         - INTERRUPTED: Cần approval, trả về thread_id và payload
         - DONE: Xử lý hoàn tất, trả về final state
+        - ERROR: Có lỗi xảy ra
     """
     try:
-        payload = item.model_dump()
-        thread = {"user_id": payload["user_id"], **payload}
-        logger.info("Processing email %s", payload.get('email_id', 'unknown'))
+        logger.info("Processing email %s (job %s)", payload.get('email_id', 'unknown'), job_id)
         
+        # Partial draft được đẩy lên dashboard (SSE) trong lúc Gemini đang stream
+        email_id = payload.get("email_id", "unknown")
+
+        def on_draft_chunk(text: str):
+            _set_draft(email_id, text)
+
         # Stream qua LangGraph để bắt interrupt payload
-        events = graph.stream(thread, stream_mode="values")
-        last = {}
-        for step in events:
-            last = step
-            if "__interrupt__" in step:
-                intr = step["__interrupt__"][0]
-                thread_id = intr["thread_id"]
-                # Thêm metadata cho UI filtering
-                intr["triage"] = last.get("triage")
-                intr["priority"] = last.get("priority")
-                intr["is_vip"] = last.get("is_vip")
-                PENDING[thread_id] = intr
-                logger.info("Email %s requires approval: %s", payload.get('email_id'), thread_id)
-                return {"status":"INTERRUPTED","thread_id":thread_id,"payload":intr["value"]}
+        # stream_mode="updates": mỗi step chỉ yield phần state node vừa thay đổi,
+        # merge dần vào `last` thay vì nhận bản copy toàn bộ state mỗi step
+        events = get_graph().astream(
+            payload,
+            {"configurable": {"on_draft_chunk": on_draft_chunk}},
+            stream_mode="updates",
+        )
+        from .graph.nodes import build_send_email_payload, new_thread_id  # graph đã được load ở trên
+        last = dict(payload)
+        try:
+            async for update in events:
+                if "__interrupt__" in update:
+                    # LangGraph yield tuple các Interrupt objects, payload nằm ở .value
+                    hitl = update["__interrupt__"][0].value
+                    # Dùng thread ID node_sensitive đã tạo cho interrupt này
+                    thread_id = hitl.get("thread_id") or new_thread_id(email_id)
+                    _queue_approval(thread_id, hitl, last)
+                    logger.info("Email %s requires approval: %s", email_id, thread_id)
+                    return {"status":"INTERRUPTED","thread_id":thread_id,"payload":hitl}
+                for patch in update.values():
+                    if patch:
+                        last.update(patch)
+        finally:
+            # Giải phóng generator (và LLM/HTTP resources nó giữ) ngay, kể cả khi return sớm
+            await events.aclose()
+            _set_draft(email_id, None)
         
         # Fallback 1: Nếu node lưu hitl_payload nhưng interrupt không surface
         if last.get("hitl_payload") and last.get("hitl_thread_id"):
             thread_id = last["hitl_thread_id"]
-            PENDING[thread_id] = {
-                "thread_id": thread_id,
-                "value": last["hitl_payload"],
-                "triage": last.get("triage"),
-                "priority": last.get("priority"),
-                "is_vip": last.get("is_vip")
-            }
-            logger.info("Email %s queued for approval (fallback): %s", payload.get('email_id'), thread_id)
+            _queue_approval(thread_id, last["hitl_payload"], last)
+            logger.info("Email %s queued for approval (fallback): %s", email_id, thread_id)
             return {"status":"INTERRUPTED","thread_id":thread_id,"payload":last["hitl_payload"]}
 
         # Fallback 2: Nếu graph hoàn thành nhưng có send_email action với draft
         if last.get("proposed_action") == "send_email" and last.get("draft"):
-            to_email = extract_sender_email(last.get("email_sender",""))
-            payload = {
-                "tool": "send_email",
-                "allow_edit": True,
-                "allow_accept": True,
-                "allow_ignore": True,
-                "allow_respond": False,
-                "priority": last.get("priority", 1),
-                "is_vip": last.get("is_vip", False),
-                "proposal": {
-                    "to": to_email or last.get("email_sender",""),
-                    "subject": "Re: %s" % (last.get('email_subject','')),
-                    "body": last.get("draft",""),
-                    "original_sender": last.get("email_sender",""),
-                    "original_subject": last.get("email_subject","")
-                }
-            }
-            import uuid
-            thread_id = "%s-%s" % (last.get('email_id','unknown'), uuid.uuid4().hex[:8])
-            PENDING[thread_id] = {
-                "thread_id": thread_id,
-                "value": payload,
-                "triage": last.get("triage"),
-                "priority": last.get("priority"),
-                "is_vip": last.get("is_vip")
-            }
-            logger.info("Email %s queued for approval (final-state fallback): %s", payload.get('email_id'), thread_id)
-            return {"status":"INTERRUPTED","thread_id":thread_id,"payload":payload}
+            hitl = build_send_email_payload(last)
+            thread_id = new_thread_id(email_id)
+            _queue_approval(thread_id, hitl, last)
+            logger.info("Email %s queued for approval (final-state fallback): %s", email_id, thread_id)
+            return {"status":"INTERRUPTED","thread_id":thread_id,"payload":hitl}
         
-        logger.info("Email %s processed successfully", payload.get('email_id'))
+        logger.info("Email %s processed successfully", email_id)
         return {"status":"DONE","state": last}
         
     except Exception as e:
-        logger.error("Error processing email: %s", e)
-        raise HTTPException(status_code=500, detail=str(e)) from e
+        # Không còn HTTP response để trả lỗi về: log lại và trả ERROR
+        logger.error("Error processing email in job %s: %s", job_id, e)
+        return {"status": "ERROR", "message": str(e)}
 
-@app.get("/pending")
-def pending():
+@app.post("/run-emails", status_code=202)
+async def run_emails(items: List[RunEmailRequest], background_tasks: BackgroundTasks):
     """
-    Lấy danh sách email đang chờ approval
+    Nhận nhiều email một lần và xử lý chúng như một batch
     
+    Classification cho cả batch được gộp vào ceil(N/CLASSIFY_BATCH_WINDOW)
+    Gemini requests thay vì N requests; sau đó mỗi email chạy graph riêng
+    (triage dùng kết quả có sẵn) đồng thời trên event loop.
+    
+    Args:
+        items: List RunEmailRequest
+        background_tasks: FastAPI BackgroundTasks để chạy job sau response
+        
     Returns:
-        List các email pending với metadata cho UI filtering:
-        - thread_id: ID của thread
-        - payload: Thông tin proposal để gửi email
-        - triage: Kết quả phân loại email
-        - priority: Độ ưu tiên (1=normal, 2=high/VIP)
-        - is_vip: Có phải VIP contact không
+        Dict với status "QUEUED", job_id và số email
+    """
+    job_id = _short_id()
+    background_tasks.add_task(_process_batch_job, [item.model_dump() for item in items], job_id)
+    logger.info("Queued %d emails as batch job %s", len(items), job_id)
+    return {"status": "QUEUED", "job_id": job_id, "count": len(items)}
+
+async def _process_batch_job(payloads: List[Dict], job_id: str) -> List[Dict]:
+    """
+    Batch classify rồi chạy graph cho từng email đồng thời (tối đa
+    GRAPH_MAX_CONCURRENCY email cùng lúc, qua graph.build.run_batch)
+    
+    Args:
+        payloads: Email data từ các RunEmailRequest
+        job_id: ID của background job (để log)
+        
+    Returns:
+        List kết quả của _process_job theo thứ tự payloads
+    """
+    from .services.genai_service import aclassify_emails_batch, prepare_body  # lazy như get_graph
+    from .services.memory_store import aget_vip_email_set
+    from .graph.build import run_batch
+
+    # VIP set mỗi user một lần cho cả batch: email từ VIP không cần Gemini
+    user_ids = list({p["user_id"] for p in payloads})
+    vip_sets = dict(zip(user_ids, await asyncio.gather(*(aget_vip_email_set(u) for u in user_ids))))
+    labels = await aclassify_emails_batch(
+        [
+            {
+                "id": p["email_id"], "subject": p["email_subject"], "body": prepare_body(p["email_body"]), "sender": p["email_sender"],
+                "is_vip": gm.extract_sender_email(p["email_sender"]) in vip_sets[p["user_id"]],
+            }
+            for p in payloads
+        ],
+        batch_size=CLASSIFY_BATCH_WINDOW,
+    )
+    for p, label in zip(payloads, labels):
+        p["triage"] = label
+    logger.info("Batch job %s classified %d emails", job_id, len(payloads))
+    sub_ids = {id(p): f"{job_id}.{i}" for i, p in enumerate(payloads)}
+    return await run_batch(
+        payloads,
+        max_concurrent=GRAPH_MAX_CONCURRENCY,
+        run=lambda p: _process_job(p, sub_ids[id(p)]),
+    )
+
+@app.get("/drafts")
+def drafts() -> Dict[str, str]:
+    """
+    Lấy các draft reply đang được generate (partial, theo email_id)
+    
+    Cho phép UI hiển thị reply ngay khi Gemini bắt đầu trả tokens, trước
+    khi email xuất hiện trong /pending. Dashboard nhận cùng dữ liệu qua
+    event "drafts" của /pending/stream; endpoint này dùng khi fallback polling.
+    
+    Returns:
+        Dict email_id -> draft text hiện có
+    """
+    return dict(_drafts_in_progress)
+
+def _pending_items(limit: int = 100, offset: int = 0, since: int = 0) -> List[Dict]:
+    """
+    Serialize pending approvals cho /pending và /pending/stream
     """
     return [
         {
-            "thread_id": k,
+            "thread_id": v["thread_id"],
             "payload": v.get("value"),
             # Surface metadata cho client-side filtering
             "triage": v.get("triage"),
             "priority": v.get("priority"),
-            "is_vip": v.get("is_vip", False)
+            "is_vip": v.get("is_vip", False),
+            "rev": v.get("rev")
         }
-        for k, v in PENDING.items()
+        for v in pending_store.list_pending(limit=limit, offset=offset, since=since)
     ]
 
+@app.get("/pending")
+def pending(
+    response: Response,
+    limit: int = Query(100, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    since: int = Query(0, ge=0),
+):
+    """
+    Lấy danh sách email đang chờ approval (mới nhất trước)
+    
+    Header X-Pending-Rev chứa revision hiện tại của queue; client gửi lại
+    giá trị này qua `since` để chỉ nhận các item mới thay vì toàn bộ queue.
+    Với `since`, header X-Pending-Deleted liệt kê (phân cách bằng dấu phẩy)
+    các thread_id đã bị xóa sau revision đó. Nếu tombstone của khoảng này đã
+    bị prune, trả về toàn bộ queue kèm header X-Pending-Snapshot: 1 để client
+    thay thế thay vì merge.
+    
+    Args:
+        response: FastAPI Response (để set X-Pending-Rev header)
+        limit: Số item tối đa trả về
+        offset: Bỏ qua bao nhiêu item đầu (pagination)
+        since: Chỉ trả về các item có rev > since
+    
+    Returns:
+        List các email pending với metadata cho UI filtering:
+        - thread_id: ID của thread
+        - payload: Thông tin proposal để gửi email
+        - triage: Kết quả phân loại email
+        - priority: Độ ưu tiên (1=normal, 2=high/VIP)
+        - is_vip: Có phải VIP contact không
+        - rev: Revision lúc item được thêm vào queue
+    """
+    last_rev, _ = pending_store.version()
+    response.headers["X-Pending-Rev"] = str(last_rev)
+    if since:
+        deleted = pending_store.deleted_since(since)
+        if deleted is None:
+            response.headers["X-Pending-Snapshot"] = "1"
+            since = 0
+        else:
+            response.headers["X-Pending-Deleted"] = ",".join(deleted)
+    return _pending_items(limit=limit, offset=offset, since=since)
+
+@app.get("/pending/stream")
+async def pending_stream(req: Request):
+    """
+    Server-Sent Events stream của pending queue
+    
+    Đẩy snapshot mới mỗi khi queue thay đổi thay vì để dashboard poll /pending.
+    Thay đổi trong process này đánh thức stream ngay; thay đổi từ uvicorn
+    worker khác được phát hiện qua pending_store.version() mỗi
+    PENDING_STREAM_RECHECK_SECONDS.
+    
+    Partial drafts đang stream (của worker này) được gửi dưới dạng event
+    "drafts" (dict email_id -> text) mỗi khi thay đổi.
+    
+    Args:
+        req: FastAPI Request object (để phát hiện client disconnect)
+        
+    Returns:
+        StreamingResponse với media type text/event-stream
+    """
+    global _pending_loop
+    _pending_loop = asyncio.get_running_loop()
+
+    async def stream():
+        seen_version = None
+        seen_drafts = None
+        while not await req.is_disconnected():
+            updated = _pending_updated_event()
+            if _drafts_rev != seen_drafts:
+                seen_drafts = _drafts_rev
+                yield b"event: drafts\ndata: " + orjson.dumps(_drafts_in_progress) + b"\n\n"
+            current = await asyncio.to_thread(pending_store.version)
+            if current != seen_version:
+                seen_version = current
+                items = await asyncio.to_thread(_pending_items)
+                yield b"data: " + orjson.dumps(items) + b"\n\n"
+            try:
+                await asyncio.wait_for(updated.wait(), timeout=PENDING_STREAM_RECHECK_SECONDS)
+            except asyncio.TimeoutError:
+                # Comment line giữ connection sống qua proxies
+                yield b": keep-alive\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.post("/approve")
 async def approve(req: Request, body: ApproveRequest):
     """
@@ -237,10 +522,9 @@ async def approve(req: Request, body: ApproveRequest):
     
     Workflow:
     1. Kiểm tra HITL secret để xác thực
-    2. Tìm thread_id trong PENDING queue
+    2. Lấy và xóa thread_id khỏi pending queue
     3. Nếu approved: merge edits và gửi email
     4. Nếu denied: chỉ log và trả về DENIED
-    5. Remove thread khỏi PENDING queue
     
     Args:
         req: FastAPI Request object (để lấy headers)
@@ -252,22 +536,21 @@ async def approve(req: Request, body: ApproveRequest):
         - DENIED: Email bị từ chối
         - ERROR: Có lỗi xảy ra
     """
-    # Kiểm tra HITL secret để bảo mật
-    secret = req.headers.get("x-hitl-secret")
-    if secret != os.getenv("HITL_SECRET"):
+    # Kiểm tra HITL secret để bảo mật (constant-time, từ chối nếu chưa cấu hình secret)
+    supplied = (req.headers.get("x-hitl-secret") or "").encode()
+    if not _HITL_SECRET or not hmac.compare_digest(supplied, _HITL_SECRET):
         raise HTTPException(403, "Forbidden")
 
     try:
-        data = body.model_dump()
-        thread_id = data["thread_id"]
-        if thread_id not in PENDING:
-            raise HTTPException(404, "No such interrupt")
+        thread_id = body.thread_id
 
-        # Lấy interrupt data và remove khỏi queue
-        intr = PENDING.pop(thread_id)
+        # Lấy interrupt data và remove khỏi queue (atomic)
+        intr = pending_store.pop(thread_id)
+        if intr is None:
+            raise HTTPException(404, "No such interrupt")
         payload = intr["value"].get("proposal", {})
-        edits = data.get("edits", {}) or {}
-        approved = data.get("approved", True)
+        edits = body.edits or {}
+        approved = body.approved
 
         if not approved:
             logger.info("Email action denied for thread %s", thread_id)
@@ -279,7 +562,7 @@ async def approve(req: Request, body: ApproveRequest):
         subject = edits.get("subject", payload.get("subject"))
         content = edits.get("body", payload.get("body",""))
         
-        msg_id = gm.send_email(to, subject, content)
+        msg_id = await gm.asend_email(to, subject, content)
         if msg_id:
             logger.info("Email sent successfully: %s", msg_id)
             return {"status":"SENT", "message_id": msg_id}
@@ -5,26 +5,44 @@ LangGraph Builder
 Xây dựng LangGraph workflow cho email processing pipeline.
 
 Workflow:
-START -> triage -> agent -> sensitive -> END
+START -> triage -> [needs_reply] agent -> [send_email] sensitive -> END
+               \-> END (fyi/spam/schedule)
 
 Architecture:
 - StateGraph với EmailState
-- Linear flow qua 3 processing nodes
+- Conditional edges: email không cần reply đi thẳng tới END, không qua
+  agent/sensitive (tiết kiệm node overhead và checkpoint writes)
 - Compile thành executable graph
+- run_batch: chạy nhiều email đồng thời trên một event loop (có giới hạn concurrency)
 """
 
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional
+
 from langgraph.graph import StateGraph, START, END
 from .state import EmailState
 from .nodes import node_triage, node_agent, node_sensitive
 
+def route_after_triage(state: EmailState) -> str:
+    """
+    Chỉ email needs_reply mới cần generate draft
+    """
+    return "agent" if state.get("triage") == "needs_reply" else END
+
+def route_after_agent(state: EmailState) -> str:
+    """
+    Chỉ action send_email mới cần HITL approval
+    """
+    return "sensitive" if state.get("proposed_action") == "send_email" else END
+
 def build_graph():
     """
     Xây dựng LangGraph workflow cho email processing
     
     Workflow:
     1. triage: Phân loại email và xác định priority
-    2. agent: Generate draft reply nếu cần
-    3. sensitive: Handle HITL approval cho sensitive actions
+    2. agent: Generate draft reply (chỉ khi needs_reply)
+    3. sensitive: Handle HITL approval (chỉ khi proposed_action là send_email)
     
     Returns:
         Compiled LangGraph ready để execute
@@ -36,10 +54,39 @@ def build_graph():
     g.add_node("agent", node_agent)
     g.add_node("sensitive", node_sensitive)
     
-    # Define linear flow
+    # Define flow: route theo kết quả triage thay vì đi qua mọi node
     g.add_edge(START, "triage")
-    g.add_edge("triage", "agent")
-    g.add_edge("agent", "sensitive")
+    g.add_conditional_edges("triage", route_after_triage, {"agent": "agent", END: END})
+    g.add_conditional_edges("agent", route_after_agent, {"sensitive": "sensitive", END: END})
     g.add_edge("sensitive", END)
     
     return g.compile()
+
+async def run_batch(states: List[EmailState], max_concurrent: int = 16, graph=None,
+                    run: Optional[Callable[[EmailState], Awaitable[Any]]] = None) -> List[Any]:
+    """
+    Chạy graph cho nhiều email đồng thời
+    
+    Các email chờ Gemini song song nên batch N email mất xấp xỉ latency của
+    email chậm nhất thay vì tổng latency. Semaphore giới hạn số request
+    đồng thời để tránh bị Gemini rate limit.
+    
+    Args:
+        states: List EmailState đầu vào
+        max_concurrent: Số email chạy cùng lúc tối đa
+        graph: Compiled graph (optional, mặc định build mới)
+        run: Coroutine function xử lý một state (optional, mặc định
+            graph.ainvoke), ví dụ app._process_job để xử lý interrupt
+        
+    Returns:
+        List kết quả của run theo thứ tự states
+    """
+    if run is None:
+        run = (graph or build_graph()).ainvoke
+    sem = asyncio.Semaphore(max_concurrent)
+
+    async def one(state: EmailState):
+        async with sem:
+            return await run(state)
+
+    return await asyncio.gather(*(one(state) for state in states))
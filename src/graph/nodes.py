@@ -8,30 +8,50 @@ Các nodes xử lý trong LangGraph workflow:
 3. node_sensitive: Handle HITL approval cho sensitive actions
 
 Architecture:
-- Mỗi node nhận EmailState và trả về updated state
+- Mỗi node nhận EmailState và chỉ trả về các keys nó thay đổi (partial update),
+  không mutate/copy toàn bộ state
+- node_triage/node_agent là async: gọi Gemini qua client.aio để nhiều email
+  chạy đồng thời trên một event loop (chạy graph bằng ainvoke/astream)
 - Error handling với fallback values
 - Logging cho debugging và monitoring
 - Interrupt mechanism cho HITL workflow
 """
 
+from langchain_core.runnables import RunnableConfig
 from langgraph.types import interrupt
 from src.graph.state import EmailState
-from src.services.genai_service import classify_email, draft_reply
+from src.services.genai_service import aclassify_email, adraft_reply, prepare_body
 from src.services.gmail_service import extract_sender_email
-from src.services.memory_store import get_profile, get_vip_contacts, is_vip_contact, log_email_action
-import uuid
+from src.services.memory_store import aget_profile, aget_vip_email_set, log_email_action
+from typing import Dict
+import asyncio
+import itertools
 import logging
+import random
 
 logger = logging.getLogger(__name__)
 
-def node_triage(state: EmailState) -> EmailState:
+# Sequence cho hitl_thread_id: start ngẫu nhiên để ID không trùng giữa các lần restart,
+# tăng bằng next() (atomic dưới GIL) thay vì tạo UUID mỗi lần
+_threadid_ctr = itertools.count(random.getrandbits(32))
+
+def new_thread_id(email_id: str) -> str:
+    """
+    Tạo thread ID cho pending approval: "<email_id>-<sequence hex>"
+    
+    Dùng chung cho node_sensitive và các fallback trong app để mọi thread ID
+    có cùng format và cùng nguồn sequence.
+    """
+    return f"{email_id}-{next(_threadid_ctr) & 0xFFFFFFFF:08x}"
+
+async def node_triage(state: EmailState) -> Dict:
     """
     Phân loại email và xác định priority dựa trên sender
     
     Workflow:
     1. Extract sender email từ header
     2. Kiểm tra VIP status
-    3. Classify email sử dụng AI
+    3. Classify email sử dụng AI (dùng triage có sẵn nếu đã batch classify)
     4. Xác định proposed action
     5. Log triage action
     
@@ -39,106 +59,143 @@ def node_triage(state: EmailState) -> EmailState:
         state: EmailState chứa email information
         
     Returns:
-        Updated EmailState với triage, priority, is_vip, proposed_action
+        Partial update với triage, priority, is_vip, proposed_action,
+        parsed_sender_email, email_body_clean_short
     """
     try:
+        user_id = state["user_id"]
+        email_id = state["email_id"]
+        subject = state["email_subject"]
         sender = state.get("email_sender", "")
+        # Lưu lại để các bước sau (API fallback) không phải parse lại
         sender_email = extract_sender_email(sender)
         
-        # Kiểm tra VIP status
-        is_vip = is_vip_contact(state["user_id"], sender_email)
-        state["is_vip"] = is_vip
-        state["priority"] = 2 if is_vip else 1
+        # Kiểm tra VIP status trên VIP set đã cache (không query DB mỗi email)
+        is_vip = sender_email in await aget_vip_email_set(user_id)
         
-        # Classify email với sender context
-        label = classify_email(state["email_subject"], state["email_body"], sender)
-        state["triage"] = label
+        # Làm sạch + cắt body một lần, dùng lại cho classify và draft
+        body_short = prepare_body(state["email_body"])
+
+        # Classify email với sender context (bỏ qua nếu đã được batch classify trước)
+        label = state.get("triage") or await aclassify_email(subject, body_short, sender, is_vip)
         
         # Xác định action dựa trên classification
         if label == "needs_reply":
-            state["proposed_action"] = "send_email"
+            proposed_action = "send_email"
         elif label == "schedule":
-            state["proposed_action"] = "create_event"
+            proposed_action = "create_event"
         else:
-            state["proposed_action"] = "none"
+            proposed_action = "none"
             
         # Log triage action
-        log_email_action(
-            state["user_id"], 
-            state["email_id"], 
-            sender, 
-            state["email_subject"], 
-            label, 
-            "triage"
-        )
+        log_email_action(user_id, email_id, sender, subject, label, "triage")
         
-        logger.info("Email %s triaged as %s (VIP: %s)", state['email_id'], label, is_vip)
-        return state
+        logger.info("Email %s triaged as %s (VIP: %s)", email_id, label, is_vip)
+        return {
+            "parsed_sender_email": sender_email,
+            "is_vip": is_vip,
+            "priority": 2 if is_vip else 1,
+            "email_body_clean_short": body_short,
+            "triage": label,
+            "proposed_action": proposed_action,
+        }
         
     except Exception as e:
         logger.error("Error in triage node: %s", e)
         # Fallback values khi có lỗi
-        state["triage"] = "fyi"
-        state["proposed_action"] = "none"
-        state["is_vip"] = False
-        state["priority"] = 1
-        return state
+        return {"triage": "fyi", "proposed_action": "none", "is_vip": False, "priority": 1}
 
-def node_agent(state: EmailState) -> EmailState:
+async def node_agent(state: EmailState, config: RunnableConfig) -> Dict:
     """
     Generate draft reply sử dụng AI với VIP context
     
+    Chỉ được gọi cho email needs_reply (route_after_triage trong build.py).
+    
     Workflow:
-    1. Kiểm tra nếu email cần reply (needs_reply)
-    2. Lấy user profile và VIP contacts
-    3. Generate draft reply với context
-    4. Log draft generation action
+    1. Lấy user profile và VIP contacts (đồng thời)
+    2. Generate draft reply với context (stream partial draft qua
+       config["configurable"]["on_draft_chunk"] nếu caller cung cấp)
+    3. Log draft generation action
     
     Args:
         state: EmailState với triage information
+        config: LangGraph run config
         
     Returns:
-        Updated EmailState với draft content
+        Partial update với draft content
     """
     try:
-        if state.get("triage") == "needs_reply":
-            # Lấy user profile và VIP contacts
-            prof = get_profile(state["user_id"])
-            vip_contacts = get_vip_contacts(state["user_id"])
-            vip_emails = [contact["email"] for contact in vip_contacts]
-            
-            # Generate draft reply với context
-            state["draft"] = draft_reply(
-                state["email_subject"], 
-                state["email_body"],
-                tone=prof["tone"], 
-                pref_hours=prof["preferred_meeting_hours"],
-                sender=state.get("email_sender", ""),
-                vip_contacts=vip_emails
-            )
-            
-            # Log draft generation action
-            log_email_action(
-                state["user_id"], 
-                state["email_id"], 
-                state.get("email_sender", ""), 
-                state["email_subject"], 
-                state["triage"], 
-                "draft_generated"
-            )
-            
-            logger.info("Generated draft for email %s", state['email_id'])
-        else:
-            state["draft"] = "No action needed."
-            
-        return state
+        user_id = state["user_id"]
+        sender = state.get("email_sender", "")
+        # Lấy user profile và VIP contacts song song
+        prof, vip_emails = await asyncio.gather(aget_profile(user_id), aget_vip_email_set(user_id))
+        
+        # Generate draft reply với context
+        draft = await adraft_reply(
+            state["email_subject"], 
+            state.get("email_body_clean_short") or prepare_body(state["email_body"]),
+            tone=prof["tone"], 
+            pref_hours=prof["preferred_meeting_hours"],
+            sender=sender,
+            vip_contacts=vip_emails,
+            on_chunk=config.get("configurable", {}).get("on_draft_chunk")
+        )
+        
+        # Log draft generation action
+        log_email_action(user_id, state["email_id"], sender, state["email_subject"], state["triage"], "draft_generated")
+        
+        logger.info("Generated draft for email %s", state['email_id'])
+        return {"draft": draft}
         
     except Exception as e:
         logger.error("Error in agent node: %s", e)
-        state["draft"] = "Error generating reply. Please review manually."
-        return state
+        return {"draft": "Error generating reply. Please review manually."}
+
+def reply_subject(subject: str) -> str:
+    """
+    Subject cho reply: thêm "Re: " trừ khi subject đã là reply
+    """
+    return subject if subject[:3].lower() == "re:" else f"Re: {subject}"
 
-def node_sensitive(state: EmailState) -> EmailState:
+# Các flag cố định của send_email HITL payload (build một lần, merge vào mỗi payload)
+_SEND_EMAIL_FLAGS = {
+    "tool": "send_email",
+    "allow_edit": True,
+    "allow_accept": True,
+    "allow_ignore": True,
+    "allow_respond": False,
+}
+
+def build_send_email_payload(state: Dict) -> Dict:
+    """
+    Tạo HITL payload cho send_email proposal từ email state
+    
+    Dùng chung cho node_sensitive và API fallback để payload luôn cùng shape.
+    
+    Args:
+        state: EmailState (hoặc dict đã merge) với draft và email fields
+        
+    Returns:
+        Dict HITL payload với flags, priority, is_vip và proposal
+    """
+    sender = state.get("email_sender", "")
+    subject = state.get("email_subject", "")
+    # node_triage đã parse sẵn, chỉ parse lại nếu state thiếu (e.g. triage lỗi)
+    sender_email = state.get("parsed_sender_email") or extract_sender_email(sender)
+    return {
+        **_SEND_EMAIL_FLAGS,
+        "priority": state.get("priority", 1),
+        "is_vip": state.get("is_vip", False),
+        "proposal": {
+            "to": sender_email or sender,
+            "subject": reply_subject(subject),
+            "body": state.get("draft", ""),
+            "original_sender": sender,
+            "original_subject": subject,
+        },
+    }
+
+def node_sensitive(state: EmailState) -> Dict:
     """
     Handle sensitive actions với human-in-the-loop approval
     
@@ -156,46 +213,28 @@ def node_sensitive(state: EmailState) -> EmailState:
         state: EmailState với proposed_action và draft
         
     Returns:
-        Updated EmailState (nếu không có interrupt)
+        Partial update (hitl payload, approvals) nếu không có interrupt
     """
-    if state.get("proposed_action") == "send_email" and state.get("draft"):
-        sender = state.get("email_sender", "")
-        sender_email = extract_sender_email(sender)
-
-        # Tạo HITL payload
-        payload = {
-            "tool": "send_email",
-            "allow_edit": True,
-            "allow_accept": True,
-            "allow_ignore": True,
-            "allow_respond": False,
-            "priority": state.get("priority", 1),
-            "is_vip": state.get("is_vip", False),
-            "proposal": {
-                "to": sender_email,
-                "subject": f"Re: {state['email_subject']}",
-                "body": state["draft"],
-                "original_sender": sender,
-                "original_subject": state["email_subject"]
-            }
-        }
+    if state.get("proposed_action") != "send_email" or not state.get("draft"):
+        return {}
 
-        # Log và raise interrupt cho HITL
-        log_email_action(
-            state["user_id"],
-            state["email_id"],
-            sender,
-            state["email_subject"],
-            state["triage"],
-            "awaiting_approval"
-        )
+    # Tạo HITL payload
+    payload = build_send_email_payload(state)
+    sender_email = payload["proposal"]["to"]
 
-        # Stash payload cho API-side HITL queue (robust ngay cả khi interrupt stream không được capture)
-        state["hitl_payload"] = payload
-        state["hitl_thread_id"] = f"{state['email_id']}-{uuid.uuid4().hex[:8]}"
+    # Log và raise interrupt cho HITL
+    log_email_action(state["user_id"], state["email_id"], state.get("email_sender", ""), state["email_subject"], state["triage"], "awaiting_approval")
 
-        logger.info("Interrupting for approval: email %s to %s", state['email_id'], sender_email)
-        decision = interrupt(payload)
-        state.setdefault("approvals", []).append(decision)
+    # Thread ID đi cùng interrupt payload để app queue pending approval đúng ID này;
+    # payload cũng được stash cho API-side HITL queue (robust ngay cả khi interrupt
+    # stream không được capture)
+    thread_id = new_thread_id(state["email_id"])
+    payload["thread_id"] = thread_id
 
-    return state
+    logger.info("Interrupting for approval: email %s to %s", state['email_id'], sender_email)
+    decision = interrupt(payload)
+    return {
+        "hitl_payload": payload,
+        "hitl_thread_id": thread_id,
+        "approvals": [*state.get("approvals", []), decision],
+    }
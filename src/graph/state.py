@@ -26,12 +26,16 @@ class EmailState(TypedDict, total=False):
         email_body: Nội dung email (required)
         email_sender: Địa chỉ người gửi (required)
         email_recipient: Địa chỉ người nhận (optional)
+        parsed_sender_email: Plain email address của sender (set bởi triage)
+        email_body_clean_short: Body đã strip HTML và cắt theo token budget (set bởi triage)
         triage: Kết quả phân loại email (needs_reply, schedule, fyi, spam)
         draft: Draft reply được generate bởi AI (optional)
         proposed_action: Hành động được đề xuất (send_email, create_event, none)
         approvals: List các approval decisions (optional)
         is_vip: Có phải VIP contact không (boolean)
         priority: Độ ưu tiên (1=normal, 2=high/VIP)
+        hitl_payload: HITL payload đã gửi cho approval (set bởi sensitive)
+        hitl_thread_id: Thread ID của pending approval (set bởi sensitive)
     """
     user_id: str
     email_id: str
@@ -39,9 +43,13 @@ class EmailState(TypedDict, total=False):
     email_body: str
     email_sender: str
     email_recipient: str
+    parsed_sender_email: str
+    email_body_clean_short: str
     triage: Literal["needs_reply","schedule","fyi","spam"]
     draft: Optional[str]
     proposed_action: Optional[str]
     approvals: List[Dict]
     is_vip: bool
     priority: int
+    hitl_payload: Dict
+    hitl_thread_id: str
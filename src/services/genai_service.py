@@ -3,7 +3,7 @@ GenAI Service - Google Gemini AI Integration
 ===========================================
 
 Service này cung cấp các chức năng AI:
-- Email classification (needs_reply, schedule, fyi, spam)
+- Email classification (needs_reply, schedule, fyi, spam), đơn lẻ hoặc theo batch
 - Draft reply generation với context awareness
 - VIP contact recognition
 - Fallback heuristics khi AI fails
@@ -13,16 +13,30 @@ Architecture:
 - Prompt engineering cho classification và generation
 - Error handling với fallback rules
 - Caching client instance
+- Cache kết quả classification cho email trùng lặp (newsletters, auto-replies):
+  LRU in-process + bảng SQLite classification_cache
 """
 
 from google import genai
+from google.genai import errors as genai_errors
 import os
+import re
+import atexit
+import asyncio
 import json
+import hashlib
 import logging
-from typing import List
+import random
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from email.utils import parseaddr
+from typing import Callable, Dict, FrozenSet, List, Optional
+
+from . import memory_store
+from .gmail_service import html_to_text
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # Gemini model configuration
@@ -30,12 +44,109 @@ MODEL = "gemini-2.5-flash"  # Latest model với tốc độ cao
 
 # Client caching
 _client = None
+_client_lock = threading.Lock()
+
+# Các label hợp lệ cho classification
+VALID_LABELS = ("needs_reply", "schedule", "fyi", "spam")
+
+# Prompt templates: build một lần ở module scope, mỗi call chỉ còn một str.format.
+# Phần instructions tĩnh đi qua system_instruction: prefix giống hệt nhau ở mọi
+# request nên Gemini có thể cache (implicit caching) thay vì prefill lại.
+_CATEGORIES = """
+- needs_reply: Requires a response or action from the recipient
+- schedule: Meeting requests, calendar invitations, or scheduling-related
+- fyi: Informational emails that don't require immediate action
+- spam: Unsolicited, promotional, or suspicious emails
+""".strip()
+
+_CLASSIFY_SYSTEM = """
+You are an email triage expert. Analyze the email and classify it strictly into one of these categories:
+
+%s
+
+Return the email_type.
+""".strip() % _CATEGORIES
+
+_CLASSIFY_BATCH_SYSTEM = """
+You are an email triage expert. Classify EACH email in the given JSON array strictly into one of these categories:
+
+%s
+
+Return one result (id, email_type) per email id.
+""".strip() % _CATEGORIES
+
+_DRAFT_SYSTEM = """
+You are a professional email assistant. Write a concise, contextual reply to the given email.
+- Be professional and helpful
+- Keep the reply concise but complete
+- Match the formality level of the original email
+- Write only the reply text (without <reply></reply> tags)
+""".strip()
+
+_CLASSIFY_TMPL = """
+Email details:
+Subject: {subject}
+From: {sender}
+Body: {body}
+""".strip()
+
+_CLASSIFY_BATCH_TMPL = """
+Emails (JSON array):
+{emails}
+""".strip()
+
+_DRAFT_TMPL = """
+Instructions:
+- Tone: {tone}
+- If scheduling is mentioned, suggest times within: {pref_hours}{vip_context}
+
+Original email:
+Subject: {subject}
+From: {sender}
+Body: {body}
+""".strip()
+
+# Structured output: Gemini trả về JSON hợp lệ theo schema, không cần strip markdown
+_CLASSIFY_CONFIG = {
+    "system_instruction": _CLASSIFY_SYSTEM,
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {"email_type": {"type": "string", "enum": list(VALID_LABELS)}},
+        "required": ["email_type"],
+    },
+}
+_BATCH_CLASSIFY_CONFIG = {
+    "system_instruction": _CLASSIFY_BATCH_SYSTEM,
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {
+            "results": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "string"},
+                        "email_type": {"type": "string", "enum": list(VALID_LABELS)},
+                    },
+                    "required": ["id", "email_type"],
+                },
+            },
+        },
+        "required": ["results"],
+    },
+}
+_DRAFT_CONFIG = {"system_instruction": _DRAFT_SYSTEM}
 
 def get_client():
     """
     Lấy hoặc tạo Gemini AI client instance
     
-    Sử dụng singleton pattern để cache client và tránh tạo lại
+    Sử dụng singleton pattern để cache client và tránh tạo lại: một client
+    (và connection pool của nó) dùng chung cho mọi node/thread/event loop.
+    Double-checked lock để các request đồng thời lúc startup không tạo
+    nhiều client.
     
     Returns:
         genai.Client instance
@@ -45,124 +156,617 @@ def get_client():
     """
     global _client
     if _client is None:
-        api_key = os.environ.get("GOOGLE_GENERATIVE_AI_API_KEY")
-        if not api_key:
-            raise ValueError("GOOGLE_GENERATIVE_AI_API_KEY environment variable is required")
-        _client = genai.Client(api_key=api_key)
+        with _client_lock:
+            if _client is None:
+                api_key = os.environ.get("GOOGLE_GENERATIVE_AI_API_KEY")
+                if not api_key:
+                    raise ValueError("GOOGLE_GENERATIVE_AI_API_KEY environment variable is required")
+                _client = genai.Client(api_key=api_key)
+                atexit.register(_close_client)
     return _client
 
-def classify_email(subject: str, body: str, sender: str = "") -> str:
+def _close_client():
+    """
+    Đóng client (và HTTP connections) khi process exit
+    """
+    global _client
+    client, _client = _client, None
+    close = getattr(client, "close", None)
+    if callable(close):
+        try:
+            close()
+        except Exception as e:
+            logger.debug("Error closing Gemini client: %s", e)
+
+# Retry/timeout/concurrency cho Gemini calls. google-genai 0.3.0 không có
+# retry hay timeout ở tầng SDK (và client.aio chỉ là requests chạy trong
+# to_thread), nên làm ở đây: retry 429/503 với backoff + jitter, timeout và
+# giới hạn số request đồng thời cho các async call
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "30"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_MAX_RETRIES = 3
+_RETRY_CODES = frozenset({429, 503})
+# Errors mà các hàm public bắt để trả về fallback
+_GEMINI_ERRORS = (ValueError, KeyError, TypeError, RuntimeError, ConnectionError, TimeoutError, genai_errors.APIError)
+# asyncio.Semaphore gắn với một event loop: mỗi loop một semaphore
+_gemini_sems: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+def _gemini_sem() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    sem = _gemini_sems.get(loop)
+    if sem is None:
+        sem = _gemini_sems[loop] = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+    return sem
+
+def _retry_delay(e: Exception, attempt: int) -> Optional[float]:
+    # None: không retry (lỗi không tạm thời hoặc hết số lần retry)
+    if not isinstance(e, genai_errors.APIError) or e.code not in _RETRY_CODES or attempt >= GEMINI_MAX_RETRIES:
+        return None
+    return min(2 ** attempt + random.random(), 16)
+
+def _generate(prompt: str, config: Dict):
+    """
+    generate_content (sync) với retry cho 429/503
+    """
+    attempt = 0
+    while True:
+        try:
+            return get_client().models.generate_content(model=MODEL, contents=prompt, config=config)
+        except genai_errors.APIError as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None:
+                raise
+            logger.warning("Gemini API %s, retrying in %.1fs", e.code, delay)
+            time.sleep(delay)
+            attempt += 1
+
+async def _agenerate(prompt: str, config: Dict):
+    """
+    generate_content (async) với retry cho 429/503, timeout GEMINI_TIMEOUT_SECONDS
+    và tối đa GEMINI_MAX_CONCURRENCY request đồng thời
+    """
+    attempt = 0
+    while True:
+        try:
+            async with _gemini_sem():
+                return await asyncio.wait_for(
+                    get_client().aio.models.generate_content(model=MODEL, contents=prompt, config=config),
+                    GEMINI_TIMEOUT_SECONDS,
+                )
+        except genai_errors.APIError as e:
+            delay = _retry_delay(e, attempt)
+            if delay is None:
+                raise
+            logger.warning("Gemini API %s, retrying in %.1fs", e.code, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+async def _agenerate_stream(prompt: str, config: Dict, on_text: Optional[Callable[[str], None]] = None) -> str:
+    """
+    generate_content_stream (async) với cùng policy như _agenerate
+    
+    Cả stream giữ một slot GEMINI_MAX_CONCURRENCY và bị giới hạn bởi
+    GEMINI_TIMEOUT_SECONDS (stream treo không giữ slot mãi). 429/503 được
+    retry nếu chưa nhận chunk nào; đã có chunk (UI đã hiển thị) thì raise.
+    
+    Returns:
+        Toàn bộ text đã stream
+    """
+    attempt = 0
+    while True:
+        text = ""
+        
+        async def consume():
+            nonlocal text
+            stream = get_client().aio.models.generate_content_stream(model=MODEL, contents=prompt, config=config)
+            async for chunk in stream:
+                if chunk.text:
+                    # Một accumulator duy nhất thay vì join lại mọi chunk mỗi lần
+                    text += chunk.text
+                    if on_text:
+                        on_text(text)
+        
+        try:
+            async with _gemini_sem():
+                await asyncio.wait_for(consume(), GEMINI_TIMEOUT_SECONDS)
+            return text
+        except genai_errors.APIError as e:
+            delay = None if text else _retry_delay(e, attempt)
+            if delay is None:
+                raise
+            logger.warning("Gemini API %s, retrying stream in %.1fs", e.code, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+# Số token (xấp xỉ) tối đa của email body đưa vào prompt
+BODY_TOKEN_BUDGET = 400
+
+# Xấp xỉ token: mỗi từ hoặc ký tự dấu câu tính là một token
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+_WS_RE = re.compile(r"\s+")
+_HTML_HINT_RE = re.compile(r"<(?:[a-zA-Z!/])")
+# Signature delimiter chuẩn RFC 3676 ("-- " trên một dòng riêng); dòng "--"
+# không có space là separator/ASCII rule bình thường nên không cắt
+_SIG_DELIM = "-- "
+# Dòng mở đầu phần thread được quote: mọi thứ sau đó là email cũ
+_REPLY_HEADER_RE = re.compile(
+    r"^\s*(?:On\s.+\swrote:|Vào\s.+\sđã viết:|-{2,}\s*Original Message\s*-{2,}|-{2,}\s*Forwarded message\s*-{2,})\s*$",
+    re.IGNORECASE,
+)
+# Dòng ngắn hơn không dedupe (lời chào, "Thanks," lặp lại là bình thường)
+_DEDUPE_MIN_CHARS = 20
+
+def _strip_quoted(text: str) -> str:
+    """
+    Bỏ các dòng quoted (">"), mọi thứ sau signature delimiter hoặc dòng
+    "On ... wrote:", và các dòng dài lặp lại (disclaimer/signature chèn nhiều lần)
+    """
+    kept: List[str] = []
+    seen = set()
+    for line in text.splitlines():
+        if line == _SIG_DELIM or _REPLY_HEADER_RE.match(line):
+            break
+        stripped = line.strip()
+        if stripped.startswith(">"):
+            continue
+        if len(stripped) >= _DEDUPE_MIN_CHARS:
+            key = hash(" ".join(stripped.split()))
+            if key in seen:
+                continue
+            seen.add(key)
+        kept.append(line)
+    return "\n".join(kept)
+
+def prepare_body(body: str, max_tokens: int = BODY_TOKEN_BUDGET) -> str:
+    """
+    Chuẩn hóa email body một lần trước khi đưa vào prompt
+    
+    Workflow:
+    1. Strip HTML tags (nếu body là HTML)
+    2. Bỏ quoted reply (dòng ">" và thread sau "On ... wrote:"), signature
+       (sau dòng "-- ") và các dòng dài lặp lại
+    3. Collapse whitespace
+    4. Cắt theo số token xấp xỉ thay vì số ký tự
+    
+    Args:
+        body: Email body gốc (plain text hoặc HTML)
+        max_tokens: Số token tối đa giữ lại
+        
+    Returns:
+        Text đã làm sạch và cắt ngắn
+    """
+    text = body or ""
+    if _HTML_HINT_RE.search(text):
+        text = html_to_text(text)
+    text = _strip_quoted(text)
+    text = _WS_RE.sub(" ", text).strip()
+    for i, m in enumerate(_TOKEN_RE.finditer(text)):
+        if i == max_tokens:
+            return text[:m.start()].rstrip()
+    return text
+
+_FALLBACK_REPLY = "Thank you for your email. I will review it and get back to you soon."
+
+# Classification cache hai tầng theo SHA1(sender|subject|body):
+# LRU in-process, rồi bảng classification_cache trong SQLite (giữ qua restart)
+CLASSIFY_CACHE_SIZE = 4096
+# CLASSIFY_NOCACHE=1: bỏ qua cache khi đọc (luôn hỏi Gemini, vẫn ghi kết quả mới),
+# ví dụ cho lần chạy test cuối trong CI
+CLASSIFY_NOCACHE = os.getenv("CLASSIFY_NOCACHE", "0") == "1"
+_classify_cache: "OrderedDict[str, str]" = OrderedDict()
+_classify_cache_lock = threading.Lock()
+
+def _classify_key(subject: str, body: str, sender: str) -> str:
+    return hashlib.sha1(f"{sender}|{subject}|{body}".encode("utf-8", "ignore")).hexdigest()
+
+def _lru_put(key: str, label: str):
+    with _classify_cache_lock:
+        _classify_cache[key] = label
+        _classify_cache.move_to_end(key)
+        if len(_classify_cache) > CLASSIFY_CACHE_SIZE:
+            _classify_cache.popitem(last=False)
+
+def _classify_cache_get(key: str) -> Optional[str]:
+    if CLASSIFY_NOCACHE:
+        return None
+    with _classify_cache_lock:
+        label = _classify_cache.get(key)
+        if label is not None:
+            _classify_cache.move_to_end(key)
+            return label
+    label = memory_store.get_cached_classification(key)
+    if label is not None:
+        _lru_put(key, label)
+    return label
+
+def _classify_cache_put(key: str, label: str):
+    _lru_put(key, label)
+    memory_store.save_classification(key, label)
+
+_VIP_CONTEXT = "\n- This is a VIP contact - be extra professional and responsive"
+
+def _classify_prompt(subject: str, body: str, sender: str) -> str:
+    """
+    Tạo prompt cho AI classification (dùng chung cho sync và async)
+    """
+    return _CLASSIFY_TMPL.format(subject=subject, sender=sender, body=body)
+
+def _parse_classification(response_text: str) -> str:
+    """
+    Parse structured JSON response từ AI thành classification label
+    
+    Args:
+        response_text: JSON text trả về từ Gemini (theo _CLASSIFY_CONFIG schema)
+        
+    Returns:
+        String classification, "fyi" nếu label không hợp lệ
+        
+    Raises:
+        ValueError/KeyError: Nếu response không đúng schema
+    """
+    label = json.loads(response_text)["email_type"]
+    if label in VALID_LABELS:
+        logger.info("Email classified as: %s", label)
+        return label
+    logger.warning("Invalid classification '%s', defaulting to 'fyi'", label)
+    return "fyi"
+
+# Keyword lists cho heuristic classification
+NEEDS_REPLY_KEYWORDS = [
+    "please reply", "vui lòng", "trả lời", "confirm", "xác nhận",
+    "yes/no", "phản hồi", "deadline", "by eod", "can you", "could you",
+    "có thể", "được không", "feedback", "ý kiến", "review", "kiểm tra"
+]
+# "?" chỉ tính là dấu hiệu cần reply nếu nằm trong subject hoặc đầu body
+QUESTION_WINDOW = 2048
+SCHEDULE_KEYWORDS = [
+    "meet", "meeting", "schedule", "hẹn", "calendar", "call",
+    "họp", "gặp", "lịch", "cuộc họp", "hẹn gặp", "lịch trình"
+]
+SPAM_KEYWORDS = [
+    "unsubscribe", "viagra", "crypto", "lottery", "win money", "win $", 
+    "congratulations", "prize", "claim", "click here", "free money",
+    "urgent", "act now", "limited time", "guaranteed", "no risk",
+    "chúc mừng", "trúng thưởng", "nhận thưởng", "khuyến mãi", "giảm giá",
+    "đầu tư", "kiếm tiền", "không rủi ro", "cơ hội duy nhất"
+]
+
+def _whole_word(keyword: str) -> str:
+    # Chỉ match nguyên từ: "call" không match "recall"/"basically". \w trong
+    # str pattern là Unicode nên boundary đúng với cả chữ có dấu tiếng Việt;
+    # đầu/cuối không phải chữ (ví dụ "win $") thì không cần boundary
+    pattern = re.escape(keyword)
+    if re.match(r"\w", keyword):
+        pattern = r"(?<!\w)" + pattern
+    if re.search(r"\w$", keyword):
+        pattern += r"(?!\w)"
+    return pattern
+
+def _keyword_alternation(keywords: List[str]) -> str:
+    # Keyword dài trước để alternation match cụm đầy đủ ("hẹn gặp" trước "hẹn")
+    return "|".join(_whole_word(k) for k in sorted(keywords, key=len, reverse=True))
+
+# Một regex cho tất cả categories (named group = category): một pass qua text
+# báo tất cả hits thay vì scan riêng cho từng category
+_KEYWORD_RE = re.compile(
+    "|".join(
+        f"(?P<{category}>{_keyword_alternation(keywords)})"
+        for category, keywords in (
+            ("spam", SPAM_KEYWORDS),
+            ("schedule", SCHEDULE_KEYWORDS),
+            ("needs_reply", NEEDS_REPLY_KEYWORDS),
+        )
+    ),
+    re.IGNORECASE,
+)
+
+def _keyword_hits(subject: str, body: str) -> Dict[str, set]:
+    """
+    Scan subject + body một lần, trả về các keyword (lowercase) đã match theo category
+    """
+    hits: Dict[str, set] = {}
+    for m in _KEYWORD_RE.finditer(f"{subject}\n{body}"):
+        hits.setdefault(m.lastgroup, set()).add(m.group().lower())
+    if "?" in subject or "?" in body[:QUESTION_WINDOW]:
+        hits.setdefault("needs_reply", set()).add("?")
+    return hits
+
+# Số spam keyword khác nhau tối thiểu (subject + body) để heuristic gán "spam"
+SPAM_MIN_HITS = 3
+
+def _heuristic_classify(subject: str, body: str) -> Optional[str]:
+    """
+    Phân loại nhanh bằng keywords, chỉ trả về label khi đủ chắc chắn
+    
+    Label này là kết quả cuối (không hỏi Gemini) nên rule cố ý bảo thủ:
+    - Có dấu hiệu cần reply: luôn để Gemini quyết định
+    - spam: subject có spam keyword và tổng cộng từ SPAM_MIN_HITS spam
+      keywords khác nhau trở lên
+    - schedule: subject có schedule keyword
+    
+    Args:
+        subject: Tiêu đề email
+        body: Nội dung email (đã qua prepare_body: bỏ quoted text và signature)
+        
+    Returns:
+        Label nếu heuristic chắc chắn, None nếu cần hỏi Gemini
+    """
+    hits = _keyword_hits(subject, body)
+    if "needs_reply" in hits:
+        return None
+    subject_hits = _keyword_hits(subject, "")
+    if "spam" in subject_hits and len(hits.get("spam", ())) >= SPAM_MIN_HITS:
+        return "spam"
+    if "schedule" in subject_hits:
+        return "schedule"
+    return None
+
+# Số email được _pre_classify quyết định (theo label) trên tổng số email đã xét
+_pre_classify_hits: Counter = Counter()
+_pre_classify_lock = threading.Lock()
+
+# Subject của reply/forward ("Re:", "Fwd:", "TL:", ...): thread đang trao đổi
+_REPLY_SUBJECT_RE = re.compile(r"^\s*(?:re|fw|fwd|tl|trả lời)\s*:", re.IGNORECASE)
+
+def _pre_classify(subject: str, body: str, is_vip: bool = False) -> Optional[str]:
+    """
+    Quyết định trực tiếp không cần Gemini cho các email rõ ràng
+    
+    - VIP sender: needs_reply
+    - Reply/forward thread: luôn hỏi Gemini (thường cần trả lời, keyword dễ sai)
+    - Còn lại: _heuristic_classify, chỉ khi keyword match đủ chắc chắn;
+      không thì fall through sang Gemini
+    
+    Args:
+        subject: Tiêu đề email
+        body: Nội dung email (đã qua prepare_body)
+        is_vip: Sender có trong VIP contacts không
+        
+    Returns:
+        Label nếu quyết định được, None nếu cần hỏi Gemini
+    """
+    if is_vip:
+        label = "needs_reply"
+    elif _REPLY_SUBJECT_RE.match(subject):
+        label = None
+    else:
+        label = _heuristic_classify(subject, body)
+    with _pre_classify_lock:
+        _pre_classify_hits["total"] += 1
+        if label:
+            _pre_classify_hits[label] += 1
+        total = _pre_classify_hits["total"]
+        hits = sum(_pre_classify_hits.values()) - total
+    if label:
+        logger.info("Email pre-classified as %s (VIP: %s, hit rate %d/%d)", label, is_vip, hits, total)
+    return label
+
+def pre_classify_stats() -> Dict[str, int]:
+    """
+    Thống kê _pre_classify: "total" email đã xét và số email bỏ qua Gemini theo label
+    """
+    with _pre_classify_lock:
+        return dict(_pre_classify_hits)
+
+def _fallback_classify(subject: str, body: str) -> str:
+    """
+    Fallback heuristic khi model quota/exceptions xảy ra
+    """
+    hits = _keyword_hits(subject, body)
+
+    # Simple rules để vẫn surface actionable emails (ưu tiên spam > schedule > needs_reply)
+    for label in ("spam", "schedule", "needs_reply"):
+        if label in hits:
+            return label
+    return "fyi"
+
+def classify_email(subject: str, body: str, sender: str = "", is_vip: bool = False) -> str:
     """
     Phân loại email thành các category: needs_reply, schedule, fyi, spam
     
     Workflow:
-    1. Tạo prompt cho Gemini AI với email details
-    2. Parse JSON response từ AI
-    3. Validate response format
-    4. Fallback sang heuristic rules nếu AI fails
+    1. Thử _pre_classify (VIP, heuristic), trả về ngay nếu chắc chắn
+    2. Trả về kết quả cached (memory rồi SQLite) nếu email giống hệt đã được phân loại
+    3. Gọi Gemini với structured output (JSON schema)
+    4. Parse JSON response từ AI
+    5. Validate label
+    6. Fallback sang heuristic rules nếu AI fails (không cache)
     
     Args:
         subject: Tiêu đề email
-        body: Nội dung email
+        body: Nội dung email (đã qua prepare_body)
         sender: Địa chỉ người gửi (optional)
+        is_vip: Sender là VIP contact (VIP luôn là needs_reply, không gọi Gemini)
         
     Returns:
         String classification: "needs_reply", "schedule", "fyi", hoặc "spam"
     """
-    try:
-        # Tạo prompt cho AI classification
-        prompt = f"""
-You are an email triage expert. Analyze the email and classify it strictly into one of these categories:
+    # Email rõ ràng (VIP/spam/schedule) không cần Gemini round trip
+    label = _pre_classify(subject, body, is_vip)
+    if label:
+        return label
 
-- needs_reply: Requires a response or action from the recipient
-- schedule: Meeting requests, calendar invitations, or scheduling-related
-- fyi: Informational emails that don't require immediate action
-- spam: Unsolicited, promotional, or suspicious emails
+    key = _classify_key(subject, body, sender)
+    cached = _classify_cache_get(key)
+    if cached:
+        return cached
 
-Email details:
-Subject: {subject}
-From: {sender}
-Body: {body[:500]}...
+    try:
+        # Gọi Gemini AI
+        resp = _generate(_classify_prompt(subject, body, sender), _CLASSIFY_CONFIG)
+        label = _parse_classification(resp.text or "")
+        _classify_cache_put(key, label)
+        return label
+    except _GEMINI_ERRORS as e:
+        logger.error("Error classifying email: %s", e)
+        return _fallback_classify(subject, body)
 
-Return ONLY a JSON object with the email_type field:
-{{
-  "email_type": "needs_reply|schedule|fyi|spam"
-}}
-""".strip()
+async def aclassify_email(subject: str, body: str, sender: str = "", is_vip: bool = False) -> str:
+    """
+    Async version của classify_email (client.aio), không block event loop
+    
+    Cho phép nhiều email chờ Gemini đồng thời trên cùng một event loop.
+    
+    Args:
+        subject: Tiêu đề email
+        body: Nội dung email (đã qua prepare_body)
+        sender: Địa chỉ người gửi (optional)
+        is_vip: Sender là VIP contact (VIP luôn là needs_reply, không gọi Gemini)
         
+    Returns:
+        String classification: "needs_reply", "schedule", "fyi", hoặc "spam"
+    """
+    # Email rõ ràng (VIP/spam/schedule) không cần Gemini round trip
+    label = _pre_classify(subject, body, is_vip)
+    if label:
+        return label
+
+    key = _classify_key(subject, body, sender)
+    cached = _classify_cache_get(key)
+    if cached:
+        return cached
+
+    try:
         # Gọi Gemini AI
-        resp = get_client().models.generate_content(model=MODEL, contents=prompt)
-        response_text = (resp.text or "").strip()
-        
-        # Parse JSON response - handle markdown code blocks
-        try:
-            # Remove markdown code block markers nếu có
-            cleaned_response = response_text.strip()
-            if cleaned_response.startswith("```json"):
-                cleaned_response = cleaned_response[7:]  # Remove ```json
-            if cleaned_response.endswith("```"):
-                cleaned_response = cleaned_response[:-3]  # Remove ```
-            cleaned_response = cleaned_response.strip()
-            
-            result = json.loads(cleaned_response)
-            label = result.get("email_type", "").lower()
-            
-            # Validate response
-            valid_labels = {"needs_reply", "schedule", "fyi", "spam"}
-            if label in valid_labels:
-                logger.info("Email classified as: %s", label)
-                return label
-            else:
-                logger.warning("Invalid classification '%s', defaulting to 'fyi'", label)
-                return "fyi"
-                
-        except (json.JSONDecodeError, KeyError) as e:
-            logger.warning("Failed to parse JSON response: %s, raw response: %s", e, response_text)
-            # Fallback: try to extract category from text nếu JSON parsing fails
-            response_lower = response_text.lower()
-            if "needs_reply" in response_lower:
-                return "needs_reply"
-            elif "schedule" in response_lower:
-                return "schedule"
-            elif "spam" in response_lower:
-                return "spam"
-            else:
-                return "fyi"
-            
-    except (ValueError, RuntimeError, ConnectionError) as e:
+        resp = await _agenerate(_classify_prompt(subject, body, sender), _CLASSIFY_CONFIG)
+        label = _parse_classification(resp.text or "")
+        _classify_cache_put(key, label)
+        return label
+    except _GEMINI_ERRORS as e:
         logger.error("Error classifying email: %s", e)
-        # Fallback heuristic khi model quota/exceptions xảy ra
-        text = f"{subject}\n{body}".lower()
+        return _fallback_classify(subject, body)
+
+def _item_key(item: Dict) -> str:
+    return _classify_key(item.get("subject", ""), item.get("body", ""), item.get("sender", ""))
+
+def _classify_batch_prompt(items: List[Dict]) -> str:
+    """
+    Tạo một prompt phân loại nhiều email cùng lúc, mỗi email có id riêng
+    """
+    emails = json.dumps([
+        {
+            "id": str(item["id"]),
+            "subject": item.get("subject", ""),
+            "sender": item.get("sender", ""),
+            "body": item.get("body") or "",
+        }
+        for item in items
+    ], ensure_ascii=False)
+    return _CLASSIFY_BATCH_TMPL.format(emails=emails)
+
+def _parse_batch_classification(response_text: str, items: List[Dict]) -> List[str]:
+    """
+    Parse batch response và map kết quả về theo id
+    
+    Email thiếu trong response hoặc có label không hợp lệ được phân loại
+    bằng heuristic fallback.
+    
+    Returns:
+        List labels theo đúng thứ tự items
+    """
+    labels: Dict[str, str] = {}
+    try:
+        for r in json.loads(response_text)["results"]:
+            if r.get("email_type") in VALID_LABELS:
+                labels[str(r.get("id"))] = r["email_type"]
+        # Chỉ cache label từ Gemini, không cache heuristic fallback
+        for item in items:
+            label = labels.get(str(item["id"]))
+            if label:
+                _classify_cache_put(_item_key(item), label)
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.warning("Failed to parse batch JSON response: %s", e)
+    missing = [item for item in items if str(item["id"]) not in labels]
+    if missing:
+        logger.warning("Batch classification missing %d/%d emails, using heuristics", len(missing), len(items))
+    return [
+        labels.get(str(item["id"])) or _fallback_classify(item.get("subject", ""), item.get("body", ""))
+        for item in items
+    ]
+
+def _split_heuristic(items: List[Dict]) -> tuple[List[Optional[str]], List[Dict]]:
+    """
+    Chạy _pre_classify và classification cache cho từng email trong batch
+    
+    Returns:
+        Tuple (labels, undecided): labels có None ở các email cần Gemini
+    """
+    labels = [
+        _pre_classify(item.get("subject", ""), item.get("body", ""), bool(item.get("is_vip")))
+        or _classify_cache_get(_item_key(item))
+        for item in items
+    ]
+    return labels, [item for item, label in zip(items, labels) if label is None]
+
+def _merge_labels(labels: List[Optional[str]], llm_labels: List[str]) -> List[str]:
+    it = iter(llm_labels)
+    return [label or next(it) for label in labels]
+
+# Số email tối đa trong một batch prompt và số batch request chạy song song
+BATCH_SIZE = 16
+BATCH_MAX_CONCURRENCY = 4
+
+def _chunks(items: List[Dict], size: int) -> List[List[Dict]]:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+async def _aclassify_window(window: List[Dict], sem: asyncio.Semaphore) -> List[str]:
+    try:
+        async with sem:
+            resp = await _agenerate(_classify_batch_prompt(window), _BATCH_CLASSIFY_CONFIG)
+        return _parse_batch_classification(resp.text or "", window)
+    except _GEMINI_ERRORS as e:
+        logger.error("Error batch classifying emails: %s", e)
+        return [_fallback_classify(item.get("subject", ""), item.get("body", "")) for item in window]
+
+async def aclassify_emails_batch(items: List[Dict], batch_size: int = BATCH_SIZE,
+                                 max_concurrency: int = BATCH_MAX_CONCURRENCY) -> List[str]:
+    """
+    Phân loại nhiều email với ceil(N/batch_size) Gemini requests (client.aio)
+    
+    Gộp tối đa batch_size email vào một prompt liệt kê các email theo id,
+    Gemini trả về JSON {"results": [{"id", "email_type"}]}.
+    Email đã được heuristic phân loại chắc chắn hoặc đã có trong cache
+    không gửi lên Gemini. Các batch request chạy song song, tối đa
+    max_concurrency request cùng lúc để tránh bị Gemini rate limit.
+    
+    Args:
+        items: List dict với id, subject, body (đã qua prepare_body), sender,
+            is_vip (optional)
+        batch_size: Số email tối đa mỗi request
+        max_concurrency: Số batch request chạy đồng thời tối đa
         
-        # Simple rules để vẫn surface actionable emails
-        needs_reply_keywords = [
-            "please reply", "vui lòng", "trả lời", "confirm", "xác nhận",
-            "yes/no", "phản hồi", "deadline", "by eod", "can you", "could you",
-            "có thể", "được không", "feedback", "ý kiến", "review", "kiểm tra",
-            "?"
-        ]
-        schedule_keywords = [
-            "meet", "meeting", "schedule", "hẹn", "calendar", "call",
-            "họp", "gặp", "lịch", "cuộc họp", "hẹn gặp", "lịch trình"
-        ]
-        spam_keywords = [
-            "unsubscribe", "viagra", "crypto", "lottery", "win money", "win $", 
-            "congratulations", "prize", "claim", "click here", "free money",
-            "urgent", "act now", "limited time", "guaranteed", "no risk",
-            "chúc mừng", "trúng thưởng", "nhận thưởng", "khuyến mãi", "giảm giá",
-            "đầu tư", "kiếm tiền", "không rủi ro", "cơ hội duy nhất"
-        ]
-
-        # Apply heuristic rules
-        if any(k in text for k in spam_keywords):
-            return "spam"
-        if any(k in text for k in schedule_keywords):
-            return "schedule"
-        if any(k in text for k in needs_reply_keywords):
-            return "needs_reply"
-        return "fyi"
-
-def draft_reply(subject: str, body: str, tone: str, pref_hours: str, sender: str = "", vip_contacts: List[str] = None) -> str:
+    Returns:
+        List classification theo thứ tự items
+    """
+    labels, undecided = _split_heuristic(items)
+    if not undecided:
+        return labels
+    sem = asyncio.Semaphore(max_concurrency)
+    results = await asyncio.gather(*(_aclassify_window(w, sem) for w in _chunks(undecided, batch_size)))
+    return _merge_labels(labels, [label for window_labels in results for label in window_labels])
+
+def _draft_prompt(subject: str, body: str, tone: str, pref_hours: str, sender: str, vip_contacts: FrozenSet[str] = frozenset()) -> str:
+    """
+    Tạo prompt cho draft reply (dùng chung cho sync và async)
+    """
+    # Kiểm tra VIP status
+    # O(1) set membership; From header có thể là "Name <addr>" nên check cả address
+    is_vip = bool(vip_contacts) and (sender in vip_contacts or parseaddr(sender)[1] in vip_contacts)
+    vip_context = _VIP_CONTEXT if is_vip else ""
+    return _DRAFT_TMPL.format(
+        tone=tone, pref_hours=pref_hours, vip_context=vip_context,
+        subject=subject, sender=sender, body=body,
+    )
+
+def _finish_draft(reply: str, sender: str) -> str:
+    reply = reply.strip()
+    if reply:
+        logger.info("Generated reply draft for %s", sender)
+        return reply
+    logger.warning("Empty reply generated")
+    return _FALLBACK_REPLY
+
+def draft_reply(subject: str, body: str, tone: str, pref_hours: str, sender: str = "", vip_contacts: FrozenSet[str] = frozenset()) -> str:
     """
     Tạo draft reply email sử dụng Gemini AI
     
@@ -174,51 +778,57 @@ def draft_reply(subject: str, body: str, tone: str, pref_hours: str, sender: str
     
     Args:
         subject: Tiêu đề email gốc
-        body: Nội dung email gốc
+        body: Nội dung email gốc (đã qua prepare_body)
         tone: Tone preference của user (e.g., "polite, concise")
         pref_hours: Preferred meeting hours
         sender: Địa chỉ người gửi
-        vip_contacts: List VIP contacts (optional)
+        vip_contacts: frozenset VIP email addresses (memory_store.get_vip_email_set)
         
     Returns:
         Generated reply text, hoặc fallback message
     """
     try:
-        # Kiểm tra VIP status
-        vip_context = ""
-        if vip_contacts and sender in vip_contacts:
-            vip_context = " (This is a VIP contact - be extra professional and responsive)"
-        
-        # Tạo prompt cho AI
-        prompt = f"""
-You are a professional email assistant. Write a concise, contextual reply to this email.
-
-Instructions:
-- Tone: {tone}
-- If scheduling is mentioned, suggest times within: {pref_hours}
-- Be professional and helpful{vip_context}
-- Keep the reply concise but complete
-- Match the formality level of the original email
-
-Original email:
-Subject: {subject}
-From: {sender}
-Body: {body[:800]}...
-
-Write your reply (without <reply></reply> tags):
-""".strip()
-        
         # Gọi Gemini AI
-        resp = get_client().models.generate_content(model=MODEL, contents=prompt)
-        reply = resp.text or ""
+        prompt = _draft_prompt(subject, body, tone, pref_hours, sender, vip_contacts)
+        resp = _generate(prompt, _DRAFT_CONFIG)
+        return _finish_draft(resp.text or "", sender)
+    except _GEMINI_ERRORS as e:
+        logger.error("Error generating reply: %s", e)
+        return _FALLBACK_REPLY
+
+async def adraft_reply(subject: str, body: str, tone: str, pref_hours: str, sender: str = "",
+                       vip_contacts: FrozenSet[str] = frozenset(), on_chunk: Optional[Callable[[str], None]] = None) -> str:
+    """
+    Async, streaming version của draft_reply (client.aio)
+    
+    Reply được stream về theo từng chunk; mỗi khi có chunk mới, on_chunk
+    nhận phần draft đã có để UI hiển thị trước khi generate xong. Timeout,
+    retry 429/503 và concurrency như _agenerate (xem _agenerate_stream).
+    
+    Args:
+        Giống draft_reply, thêm:
+        on_chunk: Callback nhận draft tích lũy sau mỗi chunk (optional)
         
-        if reply:
-            logger.info("Generated reply draft for %s", sender)
-            return reply.strip()
-        else:
-            logger.warning("Empty reply generated")
-            return "Thank you for your email. I will review it and get back to you soon."
-            
-    except (ValueError, RuntimeError, ConnectionError) as e:
+    Returns:
+        Generated reply text đầy đủ, hoặc fallback message
+    """
+    try:
+        prompt = _draft_prompt(subject, body, tone, pref_hours, sender, vip_contacts)
+        text = await _agenerate_stream(prompt, _DRAFT_CONFIG, on_chunk)
+        return _finish_draft(text, sender)
+    except _GEMINI_ERRORS as e:
         logger.error("Error generating reply: %s", e)
-        return "Thank you for your email. I will review it and get back to you soon."
\ No newline at end of file
+        return _FALLBACK_REPLY
+
+def _warm_up_client():
+    """
+    Khởi tạo client trước trong background để email đầu tiên không phải chờ
+    """
+    try:
+        get_client()
+    except Exception as e:
+        logger.warning("Gemini client warm-up failed: %s", e)
+
+# Warm up lúc import (chỉ khi có API key, tests không có key vẫn import được)
+if os.environ.get("GOOGLE_GENERATIVE_AI_API_KEY"):
+    threading.Thread(target=_warm_up_client, name="genai-warmup", daemon=True).start()
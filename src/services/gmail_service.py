@@ -14,12 +14,20 @@ Architecture:
 - OAuth2 flow cho authentication
 - Error handling cho API calls
 - Base64 encoding/decoding cho email content
+- Async entry point (asend_email) chạy call sync trong worker thread,
+  giới hạn GMAIL_MAX_CONCURRENCY call đồng thời
 """
 
 from __future__ import annotations
-import base64, os, logging, re
+import asyncio, base64, functools, os, logging, random, threading, time, weakref
+from datetime import datetime, timezone
+from email import policy
 from email.mime.text import MIMEText
-from typing import List, Dict, Optional
+from email.parser import BytesParser
+from email.utils import parseaddr
+from html.parser import HTMLParser
+from itertools import islice
+from typing import Callable, FrozenSet, List, Dict, Optional
 
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
@@ -27,8 +35,6 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.errors import HttpError
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 # Quiet noisy googleapiclient discovery cache logs
 logging.getLogger("googleapiclient.discovery_cache").setLevel(logging.ERROR)
@@ -37,16 +43,107 @@ logging.getLogger("googleapiclient.discovery_cache").setLevel(logging.ERROR)
 SCOPES_SEND = ["https://www.googleapis.com/auth/gmail.send"]
 SCOPES_READ = ["https://www.googleapis.com/auth/gmail.readonly"]
 
+# Gmail giới hạn tối đa 100 requests trong một batch HTTP call
+BATCH_LIMIT = 100
+
+# Gmail quota: 250 units/giây mỗi user. Chi phí mỗi method (quota units)
+GMAIL_QUOTA_UNITS_PER_SEC = int(os.getenv("GMAIL_QUOTA_UNITS_PER_SEC", "250"))
+UNITS_LIST = 5
+UNITS_GET = 5
+UNITS_HISTORY = 2
+UNITS_PROFILE = 1
+UNITS_SEND = 100
+
+# messages.get trả về RFC822 gốc (một base64 blob) thay vì cây JSON của format=full:
+# response nhỏ hơn, parse bằng email.parser (extract_subject_body chỉ nhận format này)
+MESSAGE_FORMAT = "raw"
+_RAW_PARSER = BytesParser(policy=policy.default)
+
+# Số Gmail call chạy đồng thời tối đa từ các async entry points (mỗi event loop)
+GMAIL_MAX_CONCURRENCY = int(os.getenv("GMAIL_MAX_CONCURRENCY", "10"))
+
+# Credentials cache theo scopes: chỉ đọc token.json một lần, background
+# thread refresh token trước khi hết hạn để request không phải chờ refresh
+TOKEN_PATH = "token.json"
+TOKEN_REFRESH_MARGIN = 300
+_creds_cache: Dict[FrozenSet[str], Credentials] = {}
+_creds_lock = threading.Lock()
+_refresher: Optional[threading.Thread] = None
+
+# asyncio.Semaphore gắn với một event loop: mỗi loop một semaphore
+_async_sems: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+# Service object cache theo scopes. httplib2 không thread-safe nên mỗi
+# thread giữ service riêng thay vì dùng chung một instance; httplib2.Http
+# của service giữ keep-alive connection nên các call trong cùng thread
+# dùng lại TCP/TLS connection.
+_local = threading.local()
+
+# Retry cho lỗi tạm thời (rate limit, server error): exponential backoff + jitter
+RETRY_STATUSES = frozenset({429, 403, 500, 503})
+# messages.send không retry 5xx: request có thể đã được xử lý, retry sẽ gửi trùng
+SEND_RETRY_STATUSES = frozenset({429, 403})
+RETRY_MAX_ATTEMPTS = 5
+RETRY_MAX_DELAY = 32
+RETRY_MAX_ELAPSED = 60
+# 403 chỉ retry khi là rate limit, không retry lỗi quyền/auth
+_RATE_LIMIT_REASONS = ("ratelimitexceeded", "userratelimitexceeded")
+
+def _persist_creds(creds: Credentials):
+    """
+    Ghi credentials vào token.json một cách atomic (ghi file tạm rồi os.replace)
+
+    Args:
+        creds: Credentials cần lưu
+    """
+    tmp_path = f"{TOKEN_PATH}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(creds.to_json())
+    os.replace(tmp_path, TOKEN_PATH)
+
+def _seconds_until_expiry(creds: Credentials) -> Optional[float]:
+    if not creds.expiry:
+        return None
+    # google-auth lưu expiry dạng naive UTC datetime
+    return (creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+
+def _refresh_loop():
+    """
+    Background loop refresh các cached credentials ~TOKEN_REFRESH_MARGIN giây trước khi hết hạn
+    """
+    while True:
+        with _creds_lock:
+            cached = list(_creds_cache.values())
+        remaining = [r for r in map(_seconds_until_expiry, cached) if r is not None]
+        time.sleep(max(30.0, min(remaining, default=3600.0) - TOKEN_REFRESH_MARGIN))
+        for creds in cached:
+            left = _seconds_until_expiry(creds)
+            if left is None or left > TOKEN_REFRESH_MARGIN or not creds.refresh_token:
+                continue
+            try:
+                creds.refresh(Request())
+                _persist_creds(creds)
+                logger.info("Refreshed Gmail OAuth token in background")
+            except Exception as e:
+                # Lần gọi API tiếp theo sẽ refresh inline trong _load_creds
+                logger.warning(f"Background token refresh failed: {e}")
+
+def _ensure_refresher():
+    global _refresher
+    if _refresher is None or not _refresher.is_alive():
+        _refresher = threading.Thread(target=_refresh_loop, name="gmail-token-refresh", daemon=True)
+        _refresher.start()
+
 def _load_creds(scopes: List[str]) -> Credentials:
     """
     Load hoặc tạo OAuth2 credentials cho Gmail API
     
     Workflow:
-    1. Kiểm tra token.json có tồn tại không
-    2. Nếu có, load credentials từ file
-    3. Nếu credentials expired, refresh token
+    1. Trả về credentials đã cache cho scopes nếu còn valid
+    2. Nếu chưa cache, load credentials từ token.json
+    3. Nếu credentials expired (background refresh chưa kịp, lệch đồng hồ), refresh inline
     4. Nếu không có hoặc invalid, chạy OAuth flow
-    5. Lưu credentials vào token.json
+    5. Lưu credentials vào token.json (atomic), cache lại và khởi động background refresh
     
     Args:
         scopes: List các Gmail API scopes cần thiết
@@ -54,29 +151,162 @@ def _load_creds(scopes: List[str]) -> Credentials:
     Returns:
         Valid Credentials object để sử dụng với Gmail API
     """
-    token_path = "token.json"
-    creds = None
-    
-    # Load existing credentials nếu có
-    if os.path.exists(token_path):
-        creds = Credentials.from_authorized_user_file(token_path, scopes)
-    
-    # Kiểm tra và refresh credentials nếu cần
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            # Refresh expired token
-            creds.refresh(Request())
-        else:
-            # Chạy OAuth flow để tạo credentials mới
-            flow = InstalledAppFlow.from_client_secrets_file("credentials/credentials.json", scopes)
-            creds = flow.run_local_server(port=0)
+    key = frozenset(scopes)
+    with _creds_lock:
+        creds = _creds_cache.get(key)
+        if creds and creds.valid:
+            return creds
         
-        # Lưu credentials vào file
-        with open(token_path, "w") as f:
-            f.write(creds.to_json())
-    
+        # Load existing credentials nếu có
+        if creds is None and os.path.exists(TOKEN_PATH):
+            creds = Credentials.from_authorized_user_file(TOKEN_PATH, scopes)
+        
+        # Kiểm tra và refresh credentials nếu cần
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                # Refresh expired token
+                creds.refresh(Request())
+            else:
+                # Chạy OAuth flow để tạo credentials mới
+                flow = InstalledAppFlow.from_client_secrets_file("credentials/credentials.json", scopes)
+                creds = flow.run_local_server(port=0)
+            
+            # Lưu credentials vào file
+            _persist_creds(creds)
+        
+        _creds_cache[key] = creds
+        _ensure_refresher()
     return creds
 
+def _is_retryable(e: HttpError, statuses: FrozenSet[int]) -> bool:
+    status = getattr(getattr(e, "resp", None), "status", None)
+    if status not in statuses:
+        return False
+    if status != 403:
+        return True
+    details = getattr(e, "error_details", None)
+    if isinstance(details, list):
+        reasons = " ".join(str(d.get("reason", "")) for d in details if isinstance(d, dict))
+    else:
+        reasons = str(details or getattr(e, "content", b"")[:512])
+    return any(r in reasons.lower() for r in _RATE_LIMIT_REASONS)
+
+def _retry_delay(e: HttpError, attempt: int) -> float:
+    # Ưu tiên Retry-After (seconds) nếu server gửi về
+    retry_after = e.resp.get("retry-after") if hasattr(e.resp, "get") else None
+    try:
+        if retry_after is not None:
+            return min(float(retry_after), RETRY_MAX_DELAY)
+    except ValueError:
+        pass
+    return min(2 ** attempt + random.random(), RETRY_MAX_DELAY)
+
+def with_retry(func: Callable = None, *, statuses: FrozenSet[int] = RETRY_STATUSES,
+               max_retries: int = RETRY_MAX_ATTEMPTS, max_elapsed: float = RETRY_MAX_ELAPSED):
+    """
+    Decorator retry Gmail API call khi gặp HttpError tạm thời
+
+    Workflow:
+    1. Gọi func, trả kết quả ngay nếu thành công
+    2. Nếu HttpError có status trong statuses (403 chỉ khi là rate limit),
+       sleep min(2**attempt + jitter, 32)s hoặc theo Retry-After
+    3. Dừng retry sau max_retries lần hoặc khi vượt max_elapsed giây,
+       raise lỗi cuối cùng để caller xử lý như trước
+
+    Args:
+        func: Hàm cần wrap
+        statuses: Các HTTP status được retry
+        max_retries: Số lần retry tối đa
+        max_elapsed: Tổng thời gian tối đa (giây) cho tất cả các lần thử
+    """
+    if func is None:
+        return functools.partial(with_retry, statuses=statuses, max_retries=max_retries, max_elapsed=max_elapsed)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except HttpError as e:
+                if attempt >= max_retries or not _is_retryable(e, statuses):
+                    raise
+                delay = _retry_delay(e, attempt)
+                if time.monotonic() - start + delay > max_elapsed:
+                    raise
+                logger.warning(f"Gmail API {e.resp.status}, retrying in {delay:.1f}s (attempt {attempt + 1}/{max_retries})")
+                time.sleep(delay)
+                attempt += 1
+    return wrapper
+
+class TokenBucket:
+    """
+    Token bucket thread-safe: acquire(n) block cho tới khi đủ n tokens
+    
+    Dùng để giữ tổng Gmail quota units/giây của process dưới giới hạn thay
+    vì để Gmail trả 429 rồi mới backoff.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n: float = 1):
+        # Request lớn hơn capacity (batch 100 messages.get) chờ bucket đầy
+        # rồi trừ đủ n: bucket âm, các request sau chờ tương ứng
+        need = min(n, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= need:
+                    self.tokens -= n
+                    return
+                wait = (need - self.tokens) / self.rate
+            time.sleep(wait)
+
+_quota = TokenBucket(GMAIL_QUOTA_UNITS_PER_SEC)
+
+@with_retry
+def _execute(request, units: int = UNITS_GET):
+    _quota.acquire(units)
+    return request.execute()
+
+@with_retry(statuses=SEND_RETRY_STATUSES)
+def _execute_send(request):
+    _quota.acquire(UNITS_SEND)
+    return request.execute()
+
+def _get_service(scopes: List[str]):
+    """
+    Lấy Gmail service object đã build cho scopes, build lazily lần đầu
+
+    Tránh gọi _load_creds + build (đọc token.json, parse discovery document,
+    tạo HTTP client mới) cho mỗi API call.
+
+    Args:
+        scopes: List các Gmail API scopes cần thiết
+
+    Returns:
+        Gmail API service (Resource) của thread hiện tại
+    """
+    services: Dict[FrozenSet[str], object] = getattr(_local, "services", None)
+    if services is None:
+        services = _local.services = {}
+    key = frozenset(scopes)
+    service = services.get(key)
+    if service is None:
+        # Dùng discovery document đóng gói sẵn trong thư viện: không fetch qua mạng,
+        # không đọc/ghi file cache mỗi lần build
+        service = services[key] = build("gmail", "v1", credentials=_load_creds(scopes),
+                                        cache_discovery=False, static_discovery=True)
+    return service
+
 def list_recent_messages(label_ids: List[str], max_results=10) -> List[str]:
     """
     Lấy danh sách message IDs từ Gmail theo labels
@@ -89,9 +319,8 @@ def list_recent_messages(label_ids: List[str], max_results=10) -> List[str]:
         List các message IDs, empty list nếu có lỗi
     """
     try:
-        creds = _load_creds(SCOPES_READ)
-        service = build("gmail", "v1", credentials=creds)
-        res = service.users().messages().list(userId="me", labelIds=label_ids, maxResults=max_results).execute()
+        service = _get_service(SCOPES_READ)
+        res = _execute(service.users().messages().list(userId="me", labelIds=label_ids, maxResults=max_results), UNITS_LIST)
         return [m["id"] for m in res.get("messages", [])]
     except HttpError as e:
         logger.error(f"Gmail API error listing messages: {e}")
@@ -100,6 +329,77 @@ def list_recent_messages(label_ids: List[str], max_results=10) -> List[str]:
         logger.error(f"Unexpected error listing messages: {e}")
         return []
 
+def get_history_id() -> Optional[str]:
+    """
+    Lấy historyId hiện tại của mailbox (users.getProfile)
+
+    Dùng để seed cursor cho list_history_message_ids khi worker khởi động
+    lần đầu hoặc khi cursor cũ đã hết hạn.
+
+    Returns:
+        historyId dạng string, None nếu có lỗi
+    """
+    try:
+        service = _get_service(SCOPES_READ)
+        profile = _execute(service.users().getProfile(userId="me"), UNITS_PROFILE)
+        return str(profile.get("historyId")) if profile.get("historyId") else None
+    except HttpError as e:
+        logger.error(f"Gmail API error getting profile: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Unexpected error getting profile: {e}")
+        return None
+
+def list_history_message_ids(start_history_id: str, label_id: Optional[str] = None) -> tuple[List[str], Optional[str]]:
+    """
+    Lấy các message ID mới được thêm kể từ start_history_id (users.history.list)
+
+    Khác với list_recent_messages, một lần poll không có email mới chỉ trả về
+    response rỗng thay vì cả trang message IDs.
+
+    Args:
+        start_history_id: historyId cursor từ lần poll trước
+        label_id: Chỉ lấy messages được thêm vào label này (optional)
+
+    Returns:
+        Tuple (message_ids, next_history_id):
+        - next_history_id là cursor mới để dùng cho lần poll sau
+        - next_history_id là None nếu cursor đã hết hạn (HTTP 404), caller cần seed lại
+        - Nếu có lỗi khác, trả về ([], start_history_id) để giữ nguyên cursor
+    """
+    try:
+        service = _get_service(SCOPES_READ)
+        # dict giữ thứ tự và dedup O(1) (một message có thể xuất hiện ở nhiều history record)
+        ids: Dict[str, None] = {}
+        next_history_id = start_history_id
+        page_token = None
+        while True:
+            kwargs = {"userId": "me", "startHistoryId": start_history_id, "historyTypes": ["messageAdded"]}
+            if label_id:
+                kwargs["labelId"] = label_id
+            if page_token:
+                kwargs["pageToken"] = page_token
+            res = _execute(service.users().history().list(**kwargs), UNITS_HISTORY)
+            for record in res.get("history", []):
+                for added in record.get("messagesAdded", []):
+                    mid = added.get("message", {}).get("id")
+                    if mid:
+                        ids[mid] = None
+            next_history_id = str(res.get("historyId", next_history_id))
+            page_token = res.get("nextPageToken")
+            if not page_token:
+                break
+        return list(ids), next_history_id
+    except HttpError as e:
+        if getattr(e, "resp", None) is not None and e.resp.status == 404:
+            logger.warning(f"History cursor {start_history_id} expired, re-seeding required")
+            return [], None
+        logger.error(f"Gmail API error listing history: {e}")
+        return [], start_history_id
+    except Exception as e:
+        logger.error(f"Unexpected error listing history: {e}")
+        return [], start_history_id
+
 def get_message(msg_id: str) -> Optional[Dict]:
     """
     Lấy full message content từ Gmail theo message ID
@@ -108,12 +408,11 @@ def get_message(msg_id: str) -> Optional[Dict]:
         msg_id: Gmail message ID
         
     Returns:
-        Dict chứa full message data, None nếu có lỗi
+        Dict chứa message data (format=raw), None nếu có lỗi
     """
     try:
-        creds = _load_creds(SCOPES_READ)
-        service = build("gmail", "v1", credentials=creds)
-        return service.users().messages().get(userId="me", id=msg_id, format="full").execute()
+        service = _get_service(SCOPES_READ)
+        return _execute(service.users().messages().get(userId="me", id=msg_id, format=MESSAGE_FORMAT))
     except HttpError as e:
         logger.error(f"Gmail API error getting message {msg_id}: {e}")
         return None
@@ -121,15 +420,88 @@ def get_message(msg_id: str) -> Optional[Dict]:
         logger.error(f"Unexpected error getting message {msg_id}: {e}")
         return None
 
+def get_messages_batch(msg_ids: List[str]) -> Dict[str, Dict]:
+    """
+    Lấy full message content cho nhiều message IDs qua Gmail batch HTTP endpoint
+
+    Gộp N lần messages.get thành ceil(N/100) HTTP round-trips thay vì N.
+
+    Args:
+        msg_ids: List các Gmail message IDs
+
+    Returns:
+        Dict message_id -> message data (theo thứ tự msg_ids), bỏ qua các message bị lỗi
+    """
+    results: Dict[str, Dict] = {}
+    if not msg_ids:
+        return results
+
+    def _on_response(request_id, response, exception):
+        if exception is not None:
+            logger.error(f"Gmail API error getting message {request_id}: {exception}")
+            return
+        results[request_id] = response
+
+    try:
+        service = _get_service(SCOPES_READ)
+        it = iter(msg_ids)
+        while chunk := list(islice(it, BATCH_LIMIT)):
+            batch = service.new_batch_http_request(callback=_on_response)
+            for mid in chunk:
+                batch.add(service.users().messages().get(userId="me", id=mid, format=MESSAGE_FORMAT), request_id=mid)
+            _execute(batch, UNITS_GET * len(chunk))
+    except HttpError as e:
+        logger.error(f"Gmail API error in batch get: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error in batch get: {e}")
+    return {mid: results[mid] for mid in msg_ids if mid in results}
+
+class _TextExtractor(HTMLParser):
+    """
+    Lấy text từ HTML, bỏ qua nội dung script/style
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self._skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style") and self._skip:
+            self._skip -= 1
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+def html_to_text(html: str) -> str:
+    """
+    Chuyển HTML thành text (decode entities, bỏ tags và nội dung script/style)
+
+    Args:
+        html: HTML string
+
+    Returns:
+        Text content, các đoạn nối bằng khoảng trắng
+    """
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return " ".join(parser.parts)
+
 def extract_subject_body(msg: Dict) -> tuple[str, str, str, str]:
     """
     Extract subject, body, sender, và recipient từ Gmail message
     
-    Workflow:
-    1. Parse headers để lấy subject, from, to
-    2. Tìm text/plain part trong message payload
-    3. Nếu không có plain text, fallback sang HTML và strip tags
-    4. Decode base64 content
+    Message là format=raw (RFC822, MESSAGE_FORMAT của get_message/get_messages_batch),
+    parse bằng email.parser:
+    1. Lấy subject, from, to từ headers
+    2. Ưu tiên text/plain, fallback sang text/html (get_body bỏ qua attachments)
+    3. HTML được chuyển thành text
     
     Args:
         msg: Gmail message dict từ API
@@ -137,56 +509,41 @@ def extract_subject_body(msg: Dict) -> tuple[str, str, str, str]:
     Returns:
         Tuple (subject, body, sender, recipient)
     """
-    # Parse headers
-    headers = {h["name"].lower(): h["value"] for h in msg["payload"]["headers"]}
-    subject = headers.get("subject", "(no subject)")
-    sender = headers.get("from", "unknown@example.com")
-    to = headers.get("to", "")
-    
-    # Extract body từ message parts
-    body = ""
-    payload = msg.get("payload", {})
-    parts = [payload] + (payload.get("parts") or [])
-    
-    for p in parts:
-        if p.get("mimeType", "").startswith("text/plain"):
-            # Ưu tiên plain text
-            data = p.get("body", {}).get("data")
-            if data:
-                body = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-                break
-        elif p.get("mimeType", "").startswith("text/html") and not body:
-            # Fallback sang HTML nếu không có plain text
-            data = p.get("body", {}).get("data")
-            if data:
-                html_body = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-                # Simple HTML to text conversion
-                import re
-                body = re.sub(r'<[^>]+>', '', html_body)
-                break
+    em = _RAW_PARSER.parsebytes(base64.urlsafe_b64decode(msg["raw"]))
+    subject = str(em["subject"] or "(no subject)")
+    sender = str(em["from"] or "unknown@example.com")
+    to = str(em["to"] or "")
     
+    part = em.get_body(preferencelist=("plain", "html"))
+    if part is None:
+        return subject, "", sender, to
+    try:
+        body = part.get_content()
+    except (LookupError, ValueError):
+        # Charset lạ/sai: decode UTF-8, bỏ byte lỗi
+        body = (part.get_payload(decode=True) or b"").decode("utf-8", errors="ignore")
+    if part.get_content_type() == "text/html":
+        body = html_to_text(body)
     return subject, body, sender, to
 
 def extract_sender_email(sender: str) -> str:
     """
     Extract plain email address từ RFC5322 From header value
     
-    Xử lý các format khác nhau của From header:
+    Xử lý các format khác nhau của From header (email.utils.parseaddr):
     - 'Alice <alice@example.com>' -> 'alice@example.com'
     - 'bob@example.com' -> 'bob@example.com'
     - '"Carol Doe" <carol.d@example.com>' -> 'carol.d@example.com'
+    - '"Doe, John" <john@example.com>' -> 'john@example.com'
     
     Args:
         sender: From header string từ Gmail
         
     Returns:
-        Plain email address, hoặc original string nếu không match
+        Plain email address, hoặc original string nếu không parse được
     """
-    try:
-        match = re.search(r"[\w\.-]+@[\w\.-]+\.[A-Za-z]{2,}", sender or "")
-        return match.group(0) if match else (sender or "")
-    except Exception:  # be resilient
-        return sender or ""
+    _, addr = parseaddr(sender or "")
+    return addr or (sender or "")
 
 def send_email(to_addr: str, subject: str, body: str) -> Optional[str]:
     """
@@ -207,8 +564,7 @@ def send_email(to_addr: str, subject: str, body: str) -> Optional[str]:
         Message ID nếu thành công, None nếu có lỗi
     """
     try:
-        creds = _load_creds(SCOPES_SEND)
-        service = build("gmail", "v1", credentials=creds)
+        service = _get_service(SCOPES_SEND)
         
         # Tạo MIME message
         msg = MIMEText(body, _charset="utf-8")
@@ -217,7 +573,7 @@ def send_email(to_addr: str, subject: str, body: str) -> Optional[str]:
         
         # Encode và gửi
         raw = base64.urlsafe_b64encode(msg.as_bytes()).decode("utf-8")
-        sent = service.users().messages().send(userId="me", body={"raw": raw}).execute()
+        sent = _execute_send(service.users().messages().send(userId="me", body={"raw": raw}))
         
         logger.info(f"Email sent successfully to {to_addr}: {sent.get('id', '')}")
         return sent.get("id", "")
@@ -235,3 +591,24 @@ def bootstrap_token():
     Chạy OAuth flow để tạo credentials cho cả READ và SEND scopes
     """
     _load_creds(list(set(SCOPES_READ + SCOPES_SEND)))
+
+def _gmail_sem() -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    sem = _async_sems.get(loop)
+    if sem is None:
+        sem = _async_sems[loop] = asyncio.Semaphore(GMAIL_MAX_CONCURRENCY)
+    return sem
+
+async def _run_async(func: Callable, *args):
+    """
+    Chạy một Gmail call sync trong worker thread, tối đa GMAIL_MAX_CONCURRENCY
+    call đồng thời trên mỗi event loop
+    """
+    async with _gmail_sem():
+        return await asyncio.to_thread(func, *args)
+
+async def asend_email(to_addr: str, subject: str, body: str) -> Optional[str]:
+    """
+    Async version của send_email (dùng trong FastAPI async endpoints)
+    """
+    return await _run_async(send_email, to_addr, subject, body)
@@ -9,23 +9,217 @@ Service này quản lý persistent storage cho:
 - Statistics và analytics
 
 Architecture:
-- SQLite database với SQLAlchemy ORM
+- SQLite database với SQLAlchemy ORM (WAL mode, connection pool)
+- Reads dùng engine.connect() (không mở transaction), writes dùng engine.begin()
+- transaction() gom nhiều thao tác vào một SQLite transaction (một commit)
 - JSON storage cho flexible profile data
 - CRUD operations cho tất cả entities
+- TTL cache in-process cho profile/VIP lookups (invalidate khi ghi)
+- Email history ghi qua background queue, batch insert
 - Error handling và logging
 """
 
-from sqlalchemy import create_engine, text
-import os, json, logging
-from typing import Dict, List, Optional
-from datetime import datetime
+from sqlalchemy import create_engine, event, text
+from contextlib import contextmanager
+from contextvars import ContextVar
+import asyncio, atexit, os, json, logging, queue, threading, time, zlib
+from typing import Dict, FrozenSet, List, Optional
+from datetime import datetime, timezone
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# SQLite database engine
-engine = create_engine(f"sqlite:///{os.getenv('DB_PATH','./data/memory.sqlite')}", future=True)
+# SQLite database engine: pool connection dùng chung giữa các threads
+engine = create_engine(
+    f"sqlite:///{os.getenv('DB_PATH','./data/memory.sqlite')}",
+    future=True,
+    connect_args={"check_same_thread": False},
+    pool_size=5,
+    pool_pre_ping=True,
+)
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_conn, _record):
+    # WAL: reads không bị block bởi writer; synchronous=NORMAL đủ an toàn với WAL
+    # và bỏ fsync mỗi commit (synchronous là setting theo connection)
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+# Connection của transaction() đang mở trong context hiện tại (thread / asyncio task)
+_tx_conn: ContextVar = ContextVar("memory_store_tx", default=None)
+
+@contextmanager
+def transaction():
+    """
+    Gom nhiều thao tác memory_store vào một SQLite transaction (một commit)
+    
+    Các hàm đọc/ghi gọi bên trong block dùng chung connection này thay vì
+    tự mở connection và commit riêng. BEGIN IMMEDIATE lấy write lock ngay
+    từ đầu nên không bị deadlock khi nâng từ read lên write. Block lồng
+    nhau chỉ tham gia vào transaction ngoài cùng.
+    
+    Example:
+        with transaction():
+            add_vip_contact("u", "boss@company.com")
+            is_vip_contact("u", "boss@company.com")
+    """
+    conn = _tx_conn.get()
+    if conn is not None:
+        yield conn
+        return
+    with engine.connect() as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        token = _tx_conn.set(conn)
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            _tx_conn.reset(token)
+
+@contextmanager
+def _connect():
+    conn = _tx_conn.get()
+    if conn is not None:
+        yield conn
+    else:
+        with engine.connect() as conn:
+            yield conn
+
+@contextmanager
+def _begin():
+    conn = _tx_conn.get()
+    if conn is not None:
+        yield conn
+    else:
+        with engine.begin() as conn:
+            yield conn
+
+# TTL cache cho các lookup đọc nhiều (profile, VIP contacts) theo user_id
+CACHE_TTL_SECONDS = 60
+CACHE_MAXSIZE = 1024
+_cache: Dict[tuple, tuple] = {}
+_cache_lock = threading.Lock()
+
+def _cache_get(key: tuple):
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit is None:
+            return None
+        if hit[0] < time.monotonic():
+            del _cache[key]
+            return None
+        return hit[1]
+
+def _cache_set(key: tuple, value):
+    if _tx_conn.get() is not None:
+        # Dữ liệu chưa commit (transaction có thể rollback): không cache
+        return
+    with _cache_lock:
+        if len(_cache) >= CACHE_MAXSIZE:
+            # Bỏ entry cũ nhất (dict giữ thứ tự insert)
+            _cache.pop(next(iter(_cache)))
+        _cache[key] = (time.monotonic() + CACHE_TTL_SECONDS, value)
+
+def invalidate_user_cache(user_id: str):
+    """
+    Xóa cached profile/VIP data của user (gọi sau mỗi lần ghi)
+
+    Args:
+        user_id: ID của user
+    """
+    with _cache_lock:
+        for key in [k for k in _cache if k[1] == user_id]:
+            del _cache[key]
+
+# Schema DDL (idempotent). SCHEMA_VERSION là fingerprint của DDL, lưu vào
+# PRAGMA user_version: init_db bỏ qua DDL khi database đã có đúng schema
+_SCHEMA_DDL = (
+    # User profiles table
+    """
+    CREATE TABLE IF NOT EXISTS profile(
+        user_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );""",
+    
+    # User preferences table (unused trong current implementation)
+    """
+    CREATE TABLE IF NOT EXISTS prefs(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        key TEXT,
+        value TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );""",
+    
+    # Email processing history
+    """
+    CREATE TABLE IF NOT EXISTS email_history(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        email_id TEXT NOT NULL,
+        sender TEXT NOT NULL,
+        subject TEXT,
+        triage_result TEXT,
+        action_taken TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );""",
+    # Index cho get_email_stats (filter theo user_id + khoảng thời gian)
+    "CREATE INDEX IF NOT EXISTS idx_hist_user_created ON email_history(user_id, created_at)",
+    
+    # VIP contacts management
+    """
+    CREATE TABLE IF NOT EXISTS vip_contacts(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        email TEXT NOT NULL,
+        name TEXT,
+        priority INTEGER DEFAULT 1,
+        notes TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user_id, email)
+    );""",
+
+    # HITL pending approvals (xem pending_store.py)
+    """
+    CREATE TABLE IF NOT EXISTS pending(
+        rev INTEGER PRIMARY KEY AUTOINCREMENT,
+        thread_id TEXT NOT NULL UNIQUE,
+        payload_json TEXT NOT NULL,
+        triage TEXT,
+        priority INTEGER,
+        is_vip INTEGER,
+        created_at REAL
+    );""",
+    # Tombstone của pending đã bị pop, để `/pending?since=` báo được item bị xóa
+    """
+    CREATE TABLE IF NOT EXISTS pending_deleted(
+        rev INTEGER PRIMARY KEY,
+        thread_id TEXT NOT NULL
+    );""",
+
+    # Ambient worker state (historyId cursor, counters) để restart không scan lại INBOX
+    """
+    CREATE TABLE IF NOT EXISTS ambient_state(
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );""",
+
+    # Classification cache (xem genai_service.classify_email)
+    """
+    CREATE TABLE IF NOT EXISTS classification_cache(
+        hash TEXT PRIMARY KEY,
+        label TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );""",
+)
+SCHEMA_VERSION = zlib.crc32("\n".join(_SCHEMA_DDL).encode()) & 0x7FFFFFFF
 
 def init_db():
     """
@@ -36,53 +230,99 @@ def init_db():
     - prefs: User preferences (unused trong current implementation)
     - email_history: Lịch sử xử lý email
     - vip_contacts: Danh sách VIP contacts
+    - pending: HITL approvals đang chờ (dùng bởi pending_store)
+    - pending_deleted: Tombstone của các pending approval đã bị xóa
+    - ambient_state: Key/value state của ambient worker (historyId cursor, stats)
+    - classification_cache: Kết quả classify_email theo hash nội dung email
+    
+    Nếu PRAGMA user_version khớp SCHEMA_VERSION thì schema đã đúng, chỉ tốn
+    một PRAGMA; ngược lại chạy DDL rồi ghi lại version.
     """
     with engine.begin() as conn:
-        # User profiles table
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS profile(
-            user_id TEXT PRIMARY KEY,
-            data TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );"""))
-        
-        # User preferences table (unused trong current implementation)
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS prefs(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            kind TEXT NOT NULL,
-            key TEXT,
-            value TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );"""))
-        
-        # Email processing history
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS email_history(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            email_id TEXT NOT NULL,
-            sender TEXT NOT NULL,
-            subject TEXT,
-            triage_result TEXT,
-            action_taken TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );"""))
-        
-        # VIP contacts management
-        conn.execute(text("""
-        CREATE TABLE IF NOT EXISTS vip_contacts(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            email TEXT NOT NULL,
-            name TEXT,
-            priority INTEGER DEFAULT 1,
-            notes TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(user_id, email)
-        );"""))
+        if conn.exec_driver_sql("PRAGMA user_version").scalar() == SCHEMA_VERSION:
+            return
+        for ddl in _SCHEMA_DDL:
+            conn.execute(text(ddl))
+        # PRAGMA không nhận bound parameter; SCHEMA_VERSION là int
+        conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    logger.info(f"Initialized database schema (version {SCHEMA_VERSION})")
+
+def get_ambient_state(key: str, default: Optional[str] = None) -> Optional[str]:
+    """
+    Đọc một giá trị state của ambient worker
+
+    Args:
+        key: Tên state (e.g., "history_id")
+        default: Giá trị trả về nếu chưa có hoặc có lỗi
+
+    Returns:
+        Giá trị đã lưu dạng string, hoặc default
+    """
+    try:
+        with _connect() as conn:
+            row = conn.execute(text("SELECT value FROM ambient_state WHERE key=:k"), {"k": key}).fetchone()
+            return row[0] if row and row[0] is not None else default
+    except Exception as e:
+        logger.error(f"Error reading ambient state {key}: {e}")
+        return default
+
+def set_ambient_state(key: str, value: str):
+    """
+    Lưu một giá trị state của ambient worker
+
+    Args:
+        key: Tên state (e.g., "history_id")
+        value: Giá trị cần lưu
+    """
+    try:
+        with _begin() as conn:
+            conn.execute(text("""
+            INSERT OR REPLACE INTO ambient_state(key, value) VALUES(:k, :v)
+            """), {"k": key, "v": str(value)})
+    except Exception as e:
+        logger.error(f"Error saving ambient state {key}: {e}")
+
+def get_cached_classification(key: str) -> Optional[str]:
+    """
+    Lấy classification đã lưu cho một email hash
+
+    Args:
+        key: SHA1 hex của (sender, subject, body)
+
+    Returns:
+        Label đã lưu, None nếu chưa có hoặc có lỗi
+    """
+    try:
+        with _connect() as conn:
+            row = conn.execute(text("SELECT label FROM classification_cache WHERE hash=:h"), {"h": key}).fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        logger.warning(f"Error reading classification cache: {e}")
+        return None
+
+def save_classification(key: str, label: str):
+    """
+    Lưu classification của email hash để các lần chạy sau không gọi lại LLM
+
+    Args:
+        key: SHA1 hex của (sender, subject, body)
+        label: Kết quả classification
+    """
+    try:
+        with _begin() as conn:
+            conn.execute(text("""
+            INSERT OR REPLACE INTO classification_cache(hash, label) VALUES(:h, :l)
+            """), {"h": key, "l": label})
+    except Exception as e:
+        logger.warning(f"Error saving classification cache: {e}")
+
+# Profile mặc định cho user chưa có row trong bảng profile
+_DEFAULT_PROFILE_JSON = json.dumps({
+    "tone": "polite, concise, friendly",
+    "preferred_meeting_hours": "Tue–Thu 09:00–11:30",
+    "vip_contacts": [],
+    "auto_cc": []
+})
 
 def get_profile(user_id: str):
     """
@@ -93,26 +333,44 @@ def get_profile(user_id: str):
         
     Returns:
         Dict chứa profile data, hoặc default profile nếu chưa có
+        (cached CACHE_TTL_SECONDS, upsert_profile ghi đè cache bằng bản mới)
     """
-    with engine.begin() as conn:
+    cached = _cache_get(("profile", user_id))
+    if cached is not None:
+        # Trả về bản copy để caller có thể sửa mà không làm bẩn cache
+        return dict(cached)
+    prof = None
+    with _connect() as conn:
         row = conn.execute(text("SELECT data FROM profile WHERE user_id=:u"), {"u": user_id}).fetchone()
         if row:
             try:
-                return json.loads(row[0])
+                prof = json.loads(row[0])
             except Exception:
                 pass
+    if prof is None:
         # Return default profile nếu chưa có
-        return {
-            "tone": "polite, concise, friendly",
-            "preferred_meeting_hours": "Tue–Thu 09:00–11:30",
-            "vip_contacts": [],
-            "auto_cc": []
-        }
+        prof = json.loads(_DEFAULT_PROFILE_JSON)
+    _cache_set(("profile", user_id), prof)
+    return dict(prof)
+
+async def aget_profile(user_id: str) -> Dict:
+    """
+    Async wrapper của get_profile (chạy DB lookup trong worker thread)
+    """
+    return await asyncio.to_thread(get_profile, user_id)
 
 def upsert_profile(user_id: str, patch: dict):
     """
     Update hoặc tạo user profile
     
+    Merge patch ngay trong SQLite (json_patch) bằng một statement thay vì
+    đọc profile, merge trong Python rồi ghi lại: không có round trip đọc
+    và hai update đồng thời không ghi đè lẫn nhau. User chưa có profile
+    được merge vào profile mặc định.
+    
+    Lưu ý (JSON merge patch, RFC 7396): key có giá trị None bị xóa khỏi
+    profile, dict lồng nhau được merge thay vì thay thế.
+    
     Args:
         user_id: ID của user
         patch: Dict chứa các fields cần update
@@ -120,13 +378,16 @@ def upsert_profile(user_id: str, patch: dict):
     Returns:
         Updated profile dict
     """
-    prof = get_profile(user_id)
-    prof.update(patch)
-    with engine.begin() as conn:
-        conn.execute(text("""
-        INSERT INTO profile(user_id, data, updated_at) VALUES(:u,:d,CURRENT_TIMESTAMP)
-        ON CONFLICT(user_id) DO UPDATE SET data=:d, updated_at=CURRENT_TIMESTAMP
-        """), {"u": user_id, "d": json.dumps(prof)})
+    with _begin() as conn:
+        data = conn.execute(text("""
+        INSERT INTO profile(user_id, data, updated_at) VALUES(:u, json_patch(:defaults, :p), CURRENT_TIMESTAMP)
+        ON CONFLICT(user_id) DO UPDATE SET data=json_patch(profile.data, :p), updated_at=CURRENT_TIMESTAMP
+        RETURNING data
+        """), {"u": user_id, "defaults": _DEFAULT_PROFILE_JSON, "p": json.dumps(patch)}).scalar()
+    prof = json.loads(data)
+    # Write-through: cache bản mới luôn thay vì để lần đọc sau phải SELECT + json.loads lại
+    invalidate_user_cache(user_id)
+    _cache_set(("profile", user_id), dict(prof))
     logger.info(f"Updated profile for user {user_id}")
     return prof
 
@@ -145,13 +406,14 @@ def add_vip_contact(user_id: str, email: str, name: str = "", priority: int = 1,
         True nếu thành công, False nếu có lỗi
     """
     try:
-        with engine.begin() as conn:
+        with _begin() as conn:
             conn.execute(text("""
             INSERT INTO vip_contacts(user_id, email, name, priority, notes)
             VALUES(:u, :e, :n, :p, :notes)
             ON CONFLICT(user_id, email) DO UPDATE SET
             name=:n, priority=:p, notes=:notes
             """), {"u": user_id, "e": email, "n": name, "p": priority, "notes": notes})
+        invalidate_user_cache(user_id)
         logger.info(f"Added VIP contact {email} for user {user_id}")
         return True
     except Exception as e:
@@ -167,21 +429,51 @@ def get_vip_contacts(user_id: str) -> List[Dict]:
         
     Returns:
         List các VIP contact dicts, sorted by priority
+        (cached CACHE_TTL_SECONDS, invalidate bởi add_vip_contact)
     """
+    cached = _cache_get(("vip_contacts", user_id))
+    if cached is not None:
+        return [dict(c) for c in cached]
     try:
-        with engine.begin() as conn:
+        with _connect() as conn:
             rows = conn.execute(text("""
             SELECT email, name, priority, notes FROM vip_contacts 
             WHERE user_id=:u ORDER BY priority DESC, name
             """), {"u": user_id}).fetchall()
-            return [{"email": row[0], "name": row[1], "priority": row[2], "notes": row[3]} for row in rows]
+        contacts = [{"email": row[0], "name": row[1], "priority": row[2], "notes": row[3]} for row in rows]
     except Exception as e:
         logger.error(f"Error getting VIP contacts: {e}")
         return []
+    _cache_set(("vip_contacts", user_id), contacts)
+    return [dict(c) for c in contacts]
+
+def get_vip_email_set(user_id: str) -> FrozenSet[str]:
+    """
+    Lấy tập email VIP của user (cached) để check membership O(1)
+
+    Args:
+        user_id: ID của user
+
+    Returns:
+        frozenset các VIP email addresses
+    """
+    cached = _cache_get(("vip_emails", user_id))
+    if cached is None:
+        cached = frozenset(c["email"] for c in get_vip_contacts(user_id))
+        _cache_set(("vip_emails", user_id), cached)
+    return cached
+
+async def aget_vip_email_set(user_id: str) -> FrozenSet[str]:
+    """
+    Async wrapper của get_vip_email_set (chạy DB lookup trong worker thread)
+    """
+    return await asyncio.to_thread(get_vip_email_set, user_id)
 
 def is_vip_contact(user_id: str, email: str) -> bool:
     """
-    Kiểm tra xem email có phải VIP contact không
+    Kiểm tra xem email có phải VIP contact không (query DB trực tiếp)
+    
+    Hot path nên dùng `email in get_vip_email_set(user_id)` (cached).
     
     Args:
         user_id: ID của user
@@ -191,7 +483,7 @@ def is_vip_contact(user_id: str, email: str) -> bool:
         True nếu là VIP contact, False nếu không
     """
     try:
-        with engine.begin() as conn:
+        with _connect() as conn:
             row = conn.execute(text("""
             SELECT 1 FROM vip_contacts WHERE user_id=:u AND email=:e
             """), {"u": user_id, "e": email}).fetchone()
@@ -200,10 +492,90 @@ def is_vip_contact(user_id: str, email: str) -> bool:
         logger.error(f"Error checking VIP contact: {e}")
         return False
 
+# Background writer cho email_history: gom log thành batch insert, ngoài hot path
+LOG_BATCH_SIZE = 50
+LOG_FLUSH_SECONDS = 0.2
+# EMAIL_LOG_SYNC=1: ghi trực tiếp (không qua queue), dùng cho tests/scripts cần đọc lại ngay
+LOG_SYNC = os.getenv("EMAIL_LOG_SYNC", "0") == "1"
+_log_queue: "queue.Queue[Dict]" = queue.Queue(maxsize=10000)
+_log_writer: Optional[threading.Thread] = None
+_log_writer_lock = threading.Lock()
+
+def _write_email_actions(rows: List[Dict]):
+    """
+    Insert nhiều email_history rows trong một transaction
+    """
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("""
+            INSERT INTO email_history(user_id, email_id, sender, subject, triage_result, action_taken, created_at)
+            VALUES(:u, :eid, :s, :subj, :triage, :action, :ts)
+            """), rows)
+        logger.debug(f"Logged {len(rows)} email actions")
+    except Exception as e:
+        logger.error(f"Error logging email actions: {e}")
+
+def _log_writer_loop():
+    while True:
+        # Chờ item đầu tiên, sau đó gom thêm tới LOG_BATCH_SIZE hoặc LOG_FLUSH_SECONDS
+        batch = [_log_queue.get()]
+        deadline = time.monotonic() + LOG_FLUSH_SECONDS
+        while len(batch) < LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_log_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _write_email_actions(batch)
+        for _ in batch:
+            _log_queue.task_done()
+
+def flush_email_log(timeout: float = 5.0):
+    """
+    Ghi ngay các email_history rows còn trong queue (gọi tự động lúc exit)
+
+    Drain queue và ghi trong thread hiện tại, sau đó chờ tối đa timeout giây
+    cho batch background writer đang ghi dở.
+
+    Args:
+        timeout: Thời gian chờ tối đa (giây) cho background writer
+    """
+    rows: List[Dict] = []
+    while True:
+        try:
+            rows.append(_log_queue.get_nowait())
+        except queue.Empty:
+            break
+    if rows:
+        _write_email_actions(rows)
+        for _ in rows:
+            _log_queue.task_done()
+    if _log_writer is not None and _log_writer.is_alive():
+        # Queue.join không có timeout: chờ trong thread phụ
+        waiter = threading.Thread(target=_log_queue.join, daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+
+def _ensure_log_writer():
+    global _log_writer
+    if _log_writer is None:
+        with _log_writer_lock:
+            if _log_writer is None:
+                _log_writer = threading.Thread(target=_log_writer_loop, name="email-history-writer", daemon=True)
+                _log_writer.start()
+                # Daemon thread bị kill lúc exit: ghi nốt các row còn trong queue
+                atexit.register(flush_email_log)
+
 def log_email_action(user_id: str, email_id: str, sender: str, subject: str, triage_result: str, action_taken: str):
     """
     Log email processing action vào history
     
+    Không ghi DB trực tiếp: row được đưa vào queue và background writer
+    insert theo batch (flush lúc exit). Nếu queue đầy hoặc EMAIL_LOG_SYNC=1
+    thì ghi trực tiếp.
+    
     Args:
         user_id: ID của user
         email_id: ID của email
@@ -212,15 +584,20 @@ def log_email_action(user_id: str, email_id: str, sender: str, subject: str, tri
         triage_result: Kết quả phân loại
         action_taken: Hành động đã thực hiện
     """
+    row = {
+        "u": user_id, "eid": email_id, "s": sender, "subj": subject,
+        "triage": triage_result, "action": action_taken,
+        # Cùng format với CURRENT_TIMESTAMP (UTC), lấy lúc enqueue thay vì lúc flush
+        "ts": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    if LOG_SYNC:
+        _write_email_actions([row])
+        return
+    _ensure_log_writer()
     try:
-        with engine.begin() as conn:
-            conn.execute(text("""
-            INSERT INTO email_history(user_id, email_id, sender, subject, triage_result, action_taken)
-            VALUES(:u, :eid, :s, :subj, :triage, :action)
-            """), {"u": user_id, "eid": email_id, "s": sender, "subj": subject, "triage": triage_result, "action": action_taken})
-        logger.info(f"Logged email action for {email_id}: {action_taken}")
-    except Exception as e:
-        logger.error(f"Error logging email action: {e}")
+        _log_queue.put_nowait(row)
+    except queue.Full:
+        _write_email_actions([row])
 
 def get_email_stats(user_id: str, days: int = 7) -> Dict:
     """
@@ -234,28 +611,27 @@ def get_email_stats(user_id: str, days: int = 7) -> Dict:
         Dict chứa triage distribution và action distribution
     """
     try:
-        with engine.begin() as conn:
-            # Lấy triage distribution
-            triage_stats = conn.execute(text("""
-            SELECT triage_result, COUNT(*) as count 
-            FROM email_history 
-            WHERE user_id=:u AND created_at >= datetime('now', '-{} days')
+        with _connect() as conn:
+            # Triage và action distribution trong một query; cutoff là bound
+            # parameter (int-cast) thay vì format vào SQL
+            rows = conn.execute(text("""
+            SELECT 'triage' AS k, triage_result AS v, COUNT(*) FROM email_history
+            WHERE user_id=:u AND created_at >= datetime('now', :cutoff)
             GROUP BY triage_result
-            """.format(days)), {"u": user_id}).fetchall()
-            
-            # Lấy action distribution
-            action_stats = conn.execute(text("""
-            SELECT action_taken, COUNT(*) as count 
-            FROM email_history 
-            WHERE user_id=:u AND created_at >= datetime('now', '-{} days')
+            UNION ALL
+            SELECT 'action' AS k, action_taken AS v, COUNT(*) FROM email_history
+            WHERE user_id=:u AND created_at >= datetime('now', :cutoff)
             GROUP BY action_taken
-            """.format(days)), {"u": user_id}).fetchall()
-            
-            return {
-                "triage_distribution": {row[0]: row[1] for row in triage_stats},
-                "action_distribution": {row[0]: row[1] for row in action_stats},
-                "period_days": days
-            }
+            """), {"u": user_id, "cutoff": f"-{int(days)} days"}).fetchall()
+        
+        stats = {"triage": {}, "action": {}}
+        for kind, value, count in rows:
+            stats[kind][value] = count
+        return {
+            "triage_distribution": stats["triage"],
+            "action_distribution": stats["action"],
+            "period_days": days
+        }
     except Exception as e:
         logger.error(f"Error getting email stats: {e}")
         return {"triage_distribution": {}, "action_distribution": {}, "period_days": days}
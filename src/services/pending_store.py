@@ -0,0 +1,166 @@
+"""
+Pending Store - HITL Approval Queue trên SQLite
+==============================================
+
+Service này lưu các email đang chờ approval (HITL interrupts) vào SQLite
+thay vì dict trong process memory, để:
+- Pending approvals không mất khi uvicorn restart/crash
+- Nhiều uvicorn workers dùng chung một queue cho /pending và /approve
+- /pending có thể paginate thay vì serialize toàn bộ queue
+
+Architecture:
+- Dùng chung engine với memory_store (bảng `pending` tạo trong init_db)
+- Payload lưu dạng JSON text
+- pop() dùng DELETE ... RETURNING để hai request không approve cùng một thread
+- Mỗi insert nhận một `rev` tăng dần (AUTOINCREMENT, không tái sử dụng) để
+  client có thể chỉ lấy các item mới (`since`) và phát hiện thay đổi (version)
+- Mỗi pop ghi một tombstone (`pending_deleted`) với rev lấy từ cùng sequence,
+  để delta polling biết item nào đã bị xóa; chỉ giữ TOMBSTONE_LIMIT tombstone
+  mới nhất, `since` cũ hơn thế thì client phải lấy lại toàn bộ queue
+- Listeners được gọi sau mỗi thay đổi để đẩy update (SSE) ngay lập tức
+"""
+
+from sqlalchemy import text
+import json, logging, time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .memory_store import engine
+
+logger = logging.getLogger(__name__)
+
+# Số tombstone tối đa được giữ lại trong pending_deleted
+TOMBSTONE_LIMIT = 1000
+
+# Callbacks được gọi sau mỗi put/pop (phải thread-safe, không block)
+_listeners: List[Callable[[], None]] = []
+
+def add_listener(callback: Callable[[], None]):
+    """
+    Đăng ký callback được gọi mỗi khi pending queue thay đổi
+
+    Args:
+        callback: Hàm không tham số, có thể được gọi từ bất kỳ thread nào
+    """
+    _listeners.append(callback)
+
+def _notify():
+    for callback in _listeners:
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"Pending listener error: {e}")
+
+def put(thread_id: str, intr: Dict):
+    """
+    Thêm hoặc thay thế một pending approval
+
+    Args:
+        thread_id: ID của thread cần approval
+        intr: Dict với "value" (HITL payload) và metadata triage, priority, is_vip
+    """
+    with engine.begin() as conn:
+        conn.execute(text("""
+        INSERT OR REPLACE INTO pending(thread_id, payload_json, triage, priority, is_vip, created_at)
+        VALUES(:t, :p, :triage, :priority, :vip, :ts)
+        """), {
+            "t": thread_id,
+            "p": json.dumps(intr.get("value")),
+            "triage": intr.get("triage"),
+            "priority": intr.get("priority"),
+            "vip": 1 if intr.get("is_vip") else 0,
+            "ts": time.time(),
+        })
+    logger.info(f"Queued pending approval {thread_id}")
+    _notify()
+
+def pop(thread_id: str) -> Optional[Dict]:
+    """
+    Lấy và xóa một pending approval trong cùng một statement
+
+    Args:
+        thread_id: ID của thread cần lấy
+
+    Returns:
+        Dict với thread_id, value, triage, priority, is_vip; None nếu không tồn tại
+    """
+    with engine.begin() as conn:
+        row = conn.execute(text("""
+        DELETE FROM pending WHERE thread_id=:t
+        RETURNING thread_id, payload_json, triage, priority, is_vip, rev
+        """), {"t": thread_id}).fetchone()
+        if row is None:
+            return None
+        # Tombstone nhận rev mới từ sequence của bảng pending (version cũng tăng theo)
+        del_rev = conn.execute(text("""
+        UPDATE sqlite_sequence SET seq = seq + 1 WHERE name='pending' RETURNING seq
+        """)).scalar()
+        conn.execute(text("INSERT INTO pending_deleted(rev, thread_id) VALUES(:r, :t)"),
+                     {"r": del_rev, "t": thread_id})
+        conn.execute(text("DELETE FROM pending_deleted WHERE rev <= :r"),
+                     {"r": del_rev - TOMBSTONE_LIMIT})
+    _notify()
+    return _row_to_item(row)
+
+def list_pending(limit: int = 100, offset: int = 0, since: int = 0) -> List[Dict]:
+    """
+    Lấy danh sách pending approvals, mới nhất trước
+
+    Args:
+        limit: Số item tối đa
+        offset: Bỏ qua bao nhiêu item đầu (pagination)
+        since: Chỉ lấy các item có rev > since (delta polling)
+
+    Returns:
+        List các dict với thread_id, value, triage, priority, is_vip, rev
+    """
+    with engine.connect() as conn:
+        rows = conn.execute(text("""
+        SELECT thread_id, payload_json, triage, priority, is_vip, rev FROM pending
+        WHERE rev > :since ORDER BY rev DESC LIMIT :limit OFFSET :offset
+        """), {"since": since, "limit": limit, "offset": offset}).fetchall()
+    return [_row_to_item(row) for row in rows]
+
+def deleted_since(since: int) -> Optional[List[str]]:
+    """
+    Lấy các thread_id đã bị xóa khỏi queue sau revision `since`
+
+    Args:
+        since: Revision client đã đồng bộ tới (X-Pending-Rev lần trước)
+
+    Returns:
+        List thread_id đã bị xóa; None nếu tombstone của khoảng đó đã bị prune
+        (client cần lấy lại toàn bộ queue)
+    """
+    with engine.connect() as conn:
+        last_rev = conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name='pending'")).scalar()
+        if since < (last_rev or 0) - TOMBSTONE_LIMIT:
+            return None
+        rows = conn.execute(text("""
+        SELECT thread_id FROM pending_deleted WHERE rev > :since ORDER BY rev
+        """), {"since": since}).fetchall()
+    return [row[0] for row in rows]
+
+def version() -> Tuple[int, int]:
+    """
+    Lấy version hiện tại của pending queue
+
+    Version thay đổi sau mỗi put/pop: rev cao nhất từng cấp (không giảm khi
+    xóa) cùng với số item còn lại.
+
+    Returns:
+        Tuple (last_rev, count)
+    """
+    with engine.connect() as conn:
+        last_rev = conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name='pending'")).scalar()
+        count = conn.execute(text("SELECT COUNT(*) FROM pending")).scalar()
+    return int(last_rev or 0), int(count or 0)
+
+def _row_to_item(row) -> Dict:
+    return {
+        "thread_id": row[0],
+        "value": json.loads(row[1]) if row[1] else None,
+        "triage": row[2],
+        "priority": row[3],
+        "is_vip": bool(row[4]),
+        "rev": row[5],
+    }
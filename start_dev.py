@@ -6,6 +6,7 @@ Starts both API server and background worker
 
 import os
 import sys
+import logging
 import subprocess
 import time
 import signal
@@ -70,6 +71,21 @@ def check_credentials():
     print("✅ Gmail credentials ready")
     return True
 
+def drain_output(process, name):
+    """
+    Forward stdout/stderr của child process ra console trong background threads
+
+    Nếu không ai đọc PIPE, child sẽ bị block khi pipe buffer (~64KB) đầy
+    lúc log nhiều.
+    """
+    def _pump(stream):
+        for line in iter(stream.readline, b""):
+            sys.stdout.write(f"[{name}] {line.decode(errors='replace')}")
+        stream.close()
+
+    for stream in (process.stdout, process.stderr):
+        threading.Thread(target=_pump, args=(stream,), name=f"{name}-output", daemon=True).start()
+
 def start_api_server():
     """Start the FastAPI server"""
     print("🚀 Starting API server...")
@@ -89,6 +105,7 @@ def start_api_server():
         
         if process.poll() is None:
             print("✅ API server started on http://localhost:8000")
+            drain_output(process, "api")
             return process
         else:
             stdout, stderr = process.communicate()
@@ -115,6 +132,7 @@ def start_worker():
         
         if process.poll() is None:
             print("✅ Background worker started")
+            drain_output(process, "worker")
             return process
         else:
             stdout, stderr = process.communicate()
@@ -127,34 +145,61 @@ def start_worker():
         print(f"❌ Failed to start background worker: {e}")
         return None
 
+def wait_for_exit(processes):
+    """
+    Block cho tới khi một trong các processes kết thúc, không polling
+    
+    POSIX: os.waitpid(-1) được kernel đánh thức ngay khi có child exit.
+    Nơi khác (Windows): mỗi process một thread chờ process.wait().
+    
+    Returns:
+        Process đã kết thúc
+    """
+    if os.name == "posix":
+        by_pid = {p.pid: p for p in processes}
+        while True:
+            pid, status = os.waitpid(-1, 0)
+            if pid in by_pid:
+                process = by_pid[pid]
+                # waitpid đã reap child: cập nhật returncode cho Popen
+                process.returncode = os.waitstatus_to_exitcode(status)
+                return process
+    
+    exited = []
+    done = threading.Event()
+    def _wait(p):
+        p.wait()
+        exited.append(p)
+        done.set()
+    for p in processes:
+        threading.Thread(target=_wait, args=(p,), daemon=True).start()
+    # Event.wait có timeout để Ctrl+C vẫn được xử lý trên Windows
+    while not done.wait(1.0):
+        pass
+    return exited[0]
+
 def monitor_processes(api_process, worker_process):
     """Monitor running processes"""
     print("\n🔄 Monitoring processes...")
     print("Press Ctrl+C to stop all services")
     
+    names = {api_process: "API server", worker_process: "Background worker"}
+    processes = [p for p in (api_process, worker_process) if p]
     try:
-        while True:
-            # Check if processes are still running
-            if api_process and api_process.poll() is not None:
-                print("❌ API server stopped unexpectedly")
-                break
-                
-            if worker_process and worker_process.poll() is not None:
-                print("❌ Background worker stopped unexpectedly")
-                break
-            
-            time.sleep(5)
+        stopped = wait_for_exit(processes)
+        print(f"❌ {names[stopped]} stopped unexpectedly (exit code {stopped.returncode})")
             
     except KeyboardInterrupt:
         print("\n🛑 Shutting down services...")
         
-        if api_process:
-            api_process.terminate()
-            print("✅ API server stopped")
-            
-        if worker_process:
-            worker_process.terminate()
-            print("✅ Background worker stopped")
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            print(f"✅ {names[process]} stopped")
         
         print("👋 Goodbye!")
 
@@ -167,6 +212,12 @@ def main():
     if not check_environment():
         sys.exit(1)
     
+    # Configure logging cho các module import trong process này (bootstrap_token)
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    
     # Check credentials
     if not check_credentials():
         print("⚠️ Continuing with limited functionality...")
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Regression test cho keyword pre-filter của genai_service
+
+Label của _heuristic_classify là kết quả cuối (không hỏi Gemini), nên các
+email bình thường không được bị gán nhầm spam/schedule. Không gọi API.
+"""
+
+import sys
+
+def test_substrings_do_not_match():
+    """Keyword chỉ match nguyên từ: "call" không nằm trong basically/typically/recall"""
+    from src.services.genai_service import _heuristic_classify, _keyword_hits
+    body = "Basically this is typically what we do; I recall the numbers from last quarter."
+    assert "schedule" not in _keyword_hits("Quarterly numbers", body)
+    assert _heuristic_classify("Quarterly numbers", body) is None
+
+def test_business_mail_with_spam_words_is_not_spam():
+    from src.services.genai_service import _heuristic_classify
+    assert _heuristic_classify(
+        "Re: contract renewal",
+        "Urgent: legal will claim the penalty if the contract is not signed this week.",
+    ) != "spam"
+    assert _heuristic_classify(
+        "Crypto library upgrade",
+        "The cryptography package has an urgent security fix, we should bump it.",
+    ) != "spam"
+
+def test_vietnamese_whole_words():
+    from src.services.genai_service import _heuristic_classify, _keyword_hits
+    assert "schedule" in _keyword_hits("Họp team tuần tới", "")
+    assert _heuristic_classify("Họp team tuần tới", "Chúng ta có cuộc họp team vào thứ 3.") == "schedule"
+    assert _heuristic_classify(
+        "Chúc mừng! Bạn đã trúng thưởng!",
+        "Bạn đã trúng 10 triệu đồng! Nhấn vào đây để nhận thưởng ngay!",
+    ) == "spam"
+
+def test_obvious_spam():
+    from src.services.genai_service import _heuristic_classify
+    assert _heuristic_classify(
+        "Win $1000 now!",
+        "Congratulations! You've won $1000! Click here to claim your prize!",
+    ) == "spam"
+
+def test_reply_signal_goes_to_gemini():
+    from src.services.genai_service import _heuristic_classify
+    assert _heuristic_classify("Meeting tomorrow", "Can you confirm the meeting time?") is None
+
+def test_pre_classify_falls_through_to_gemini():
+    """VIP vẫn short-circuit; reply thread và email không chắc chắn phải hỏi Gemini"""
+    from src.services.genai_service import _pre_classify
+    assert _pre_classify("Quarterly numbers", "See attached.", is_vip=True) == "needs_reply"
+    assert _pre_classify("Re: meeting notes", "Notes from the meeting are attached.") is None
+    assert _pre_classify("Quarterly numbers", "See attached.") is None
+    assert _pre_classify("Team meeting moved", "The weekly meeting moves to 3 PM.") == "schedule"
+
+if __name__ == "__main__":
+    tests = [v for k, v in list(globals().items()) if k.startswith("test_")]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {test.__name__}: {e}")
+    sys.exit(1 if failed else 0)
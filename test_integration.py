@@ -4,62 +4,76 @@ Integration test script for Ambient Email Agent
 Tests the complete workflow from email processing to HITL approval
 """
 
+import io
 import os
 import sys
 import json
+import socket
 import time
-import requests
+import threading
+import atexit
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, Any
 
-# Add src to path
-sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'src'))
+# Các module nặng (requests, LangGraph, google-genai) chỉ import bên trong test cần chúng,
+# để collection và test_environment không phải trả chi phí import
+__all__ = [
+    "test_environment", "test_services", "test_api_server",
+    "test_email_processing", "test_graph_workflow", "test_vip_contacts",
+]
+
+def _requests():
+    import requests
+    return requests
+
+@functools.lru_cache(maxsize=None)
+def _session():
+    """Một HTTP session cho cả suite: giữ keep-alive connection tới API server"""
+    from requests.adapters import HTTPAdapter
+    session = _requests().Session()
+    session.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=0))
+    atexit.register(session.close)
+    return session
+
+@functools.lru_cache(maxsize=None)
+def _graph():
+    """Graph build một lần cho cả suite (dưới pytest: fixture `graph` trong conftest)"""
+    from src.graph.build import build_graph
+    return build_graph()
+
+REQUIRED_ENV_VARS = frozenset({'GOOGLE_GENERATIVE_AI_API_KEY', 'HITL_SECRET'})
 
 def test_environment():
     """Test environment setup"""
     print("🔍 Testing environment setup...")
     
-    required_vars = ['GOOGLE_GENERATIVE_AI_API_KEY', 'HITL_SECRET']
-    missing_vars = []
-    
-    for var in required_vars:
-        if not os.getenv(var):
-            missing_vars.append(var)
-    
-    if missing_vars:
-        print(f"❌ Missing environment variables: {missing_vars}")
-        print("Please set these in your .env file")
-        return False
+    env = os.environ
+    missing_vars = sorted(v for v in REQUIRED_ENV_VARS if not env.get(v))
+    assert not missing_vars, f"Missing environment variables: {missing_vars} (set these in your .env file)"
     
     print("✅ Environment variables configured")
-    return True
 
-def test_services():
+def test_services(graph):
     """Test service imports and initialization"""
     print("🔍 Testing service imports...")
     
-    try:
-        from src.services.memory_store import init_db, get_profile
-        from src.services.genai_service import classify_email, draft_reply
-        from src.services.gmail_service import extract_sender_email
-        from src.graph.build import build_graph
-        
-        # Initialize database
-        init_db()
-        print("✅ Database initialized")
-        
-        # Test profile retrieval
-        profile = get_profile("test_user")
-        print(f"✅ Profile system working: {profile['tone']}")
-        
-        # Test graph building
-        graph = build_graph()
-        print("✅ LangGraph built successfully")
-        
-        return True
-        
-    except Exception as e:
-        print(f"❌ Service test failed: {e}")
-        return False
+    from src.services.memory_store import init_db, get_profile
+    from src.services.genai_service import classify_email, draft_reply
+    from src.services.gmail_service import extract_sender_email
+    
+    # Initialize database
+    init_db()
+    print("✅ Database initialized")
+    
+    # Test profile retrieval
+    profile = get_profile("test_user")
+    print(f"✅ Profile system working: {profile['tone']}")
+    
+    # Graph build bởi fixture / _graph(), dùng chung với test_graph_workflow
+    assert graph is not None
+    print("✅ LangGraph built successfully")
 
 def test_api_server():
     """Test API server endpoints"""
@@ -67,164 +81,203 @@ def test_api_server():
     
     base_url = "http://localhost:8000"
     
-    try:
-        # Test health endpoint (if exists)
-        response = requests.get(f"{base_url}/", timeout=5)
-        if response.status_code == 200:
-            print("✅ API server is running")
-        else:
-            print(f"⚠️ API server responded with status {response.status_code}")
-            
-        return True
-        
-    except requests.exceptions.ConnectionError:
-        print("❌ API server is not running")
-        print("Please start the server with: uvicorn src.app:app --reload")
-        return False
-    except Exception as e:
-        print(f"❌ API test failed: {e}")
-        return False
+    # Probe TCP nhanh (200ms) trước: server không chạy thì fail ngay thay vì chờ HTTP timeout 5s
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.settimeout(0.2)
+        assert sock.connect_ex(("127.0.0.1", 8000)) == 0, (
+            "API server is not running. Please start the server with: uvicorn src.app:app --reload"
+        )
+    
+    # Test health endpoint (if exists); server treo → requests Timeout sau 5s
+    response = _session().get(f"{base_url}/", timeout=5)
+    if response.status_code == 200:
+        print("✅ API server is running")
+    else:
+        print(f"⚠️ API server responded with status {response.status_code}")
 
 def test_email_processing():
     """Test email processing workflow"""
     print("🔍 Testing email processing workflow...")
     
-    try:
-        from src.services.genai_service import classify_email, draft_reply
-        from src.services.memory_store import get_profile
-        
-        # Test email classification
-        test_subject = "Meeting Request for Next Week"
-        test_body = "Hi, can we schedule a meeting for next Tuesday at 2 PM? Thanks!"
-        test_sender = "colleague@company.com"
-        
-        classification = classify_email(test_subject, test_body, test_sender)
-        print(f"✅ Email classified as: {classification}")
-        
-        # Test draft generation
-        profile = get_profile("test_user")
-        draft = draft_reply(
-            test_subject, 
-            test_body, 
-            profile["tone"], 
-            profile["preferred_meeting_hours"],
-            test_sender
-        )
-        print(f"✅ Draft generated: {draft[:100]}...")
-        
-        return True
-        
-    except Exception as e:
-        print(f"❌ Email processing test failed: {e}")
-        return False
+    from src.services.genai_service import classify_email, draft_reply
+    from src.services.memory_store import get_profile
+    
+    # Test email classification
+    test_subject = "Meeting Request for Next Week"
+    test_body = "Hi, can we schedule a meeting for next Tuesday at 2 PM? Thanks!"
+    test_sender = "colleague@company.com"
+    
+    classification = classify_email(test_subject, test_body, test_sender)
+    print(f"✅ Email classified as: {classification}")
+    
+    # Test draft generation
+    profile = get_profile("test_user")
+    draft = draft_reply(
+        test_subject, 
+        test_body, 
+        profile["tone"], 
+        profile["preferred_meeting_hours"],
+        test_sender
+    )
+    print(f"✅ Draft generated: {draft[:100]}...")
 
-def test_graph_workflow():
+def test_graph_workflow(graph):
     """Test complete LangGraph workflow"""
     print("🔍 Testing LangGraph workflow...")
     
-    try:
-        from src.graph.build import build_graph
-        
-        graph = build_graph()
-        
-        # Test state
-        test_state = {
-            "user_id": "test_user",
-            "email_id": "test_123",
-            "email_subject": "Test Email",
-            "email_body": "This is a test email for integration testing",
-            "email_sender": "test@example.com",
-            "email_recipient": "user@example.com"
-        }
-        
-        # Run the graph
-        result = graph.invoke(test_state)
-        print(f"✅ Graph workflow completed: {result.get('triage', 'unknown')}")
-        
-        return True
-        
-    except Exception as e:
-        print(f"❌ Graph workflow test failed: {e}")
-        return False
+    # Test state
+    test_state = {
+        "user_id": "test_user",
+        "email_id": "test_123",
+        "email_subject": "Test Email",
+        "email_body": "This is a test email for integration testing",
+        "email_sender": "test@example.com",
+        "email_recipient": "user@example.com"
+    }
+    
+    # Run the graph (nodes là async nên dùng ainvoke)
+    result = asyncio.run(graph.ainvoke(test_state))
+    print(f"✅ Graph workflow completed: {result.get('triage', 'unknown')}")
 
 def test_vip_contacts():
     """Test VIP contacts functionality"""
     print("🔍 Testing VIP contacts...")
     
-    try:
-        from src.services.memory_store import add_vip_contact, get_vip_contacts, is_vip_contact
-        
+    from src.services.memory_store import add_vip_contact, get_vip_contacts, is_vip_contact, transaction
+    
+    # add → check → get trong một SQLite transaction (một commit; assert fail thì rollback)
+    with transaction():
         # Add VIP contact
-        success = add_vip_contact("test_user", "boss@company.com", "My Boss", priority=2)
-        if success:
-            print("✅ VIP contact added")
-        else:
-            print("❌ Failed to add VIP contact")
-            return False
+        assert add_vip_contact("test_user", "boss@company.com", "My Boss", priority=2), "Failed to add VIP contact"
+        print("✅ VIP contact added")
         
         # Check VIP status
-        is_vip = is_vip_contact("test_user", "boss@company.com")
-        if is_vip:
-            print("✅ VIP contact recognition working")
-        else:
-            print("❌ VIP contact recognition failed")
-            return False
+        assert is_vip_contact("test_user", "boss@company.com"), "VIP contact recognition failed"
+        print("✅ VIP contact recognition working")
         
         # Get VIP contacts
         vip_contacts = get_vip_contacts("test_user")
-        print(f"✅ VIP contacts retrieved: {len(vip_contacts)} contacts")
-        
-        return True
-        
-    except Exception as e:
-        print(f"❌ VIP contacts test failed: {e}")
-        return False
+    print(f"✅ VIP contacts retrieved: {len(vip_contacts)} contacts")
+
+# Output của các test chạy song song: mỗi thread ghi vào buffer riêng,
+# in ra nguyên khối (dưới print_lock) khi test xong để không bị lẫn
+print_lock = threading.Lock()
+_output = threading.local()
+
+class _ThreadStdout(io.TextIOBase):
+    def __init__(self, real):
+        self.real = real
+
+    def write(self, s):
+        buf = getattr(_output, "buf", None)
+        return (buf or self.real).write(s)
+
+    def flush(self):
+        self.real.flush()
+
+def _run_test(test_name, test_func):
+    """
+    Chạy một test, trả về (passed, output đã buffer)
+    """
+    _output.buf = io.StringIO()
+    try:
+        print(f"\n{'='*50}")
+        print(f"Running: {test_name}")
+        print('='*50)
+        try:
+            test_func()
+            passed = True
+            print(f"✅ {test_name} PASSED")
+        except Exception as e:
+            # Test báo lỗi bằng assert/exception (cùng cơ chế pytest dùng)
+            passed = False
+            print(f"❌ {test_name} FAILED: {e}")
+        return passed, _output.buf.getvalue()
+    finally:
+        _output.buf = None
 
 def run_all_tests():
-    """Run all integration tests"""
+    """
+    Run all integration tests
+    
+    Environment và Service Imports (init_db) chạy tuần tự trước như
+    prerequisite; các test còn lại độc lập, chờ I/O (HTTP, SQLite, Gemini)
+    nên chạy song song: tổng thời gian ≈ test chậm nhất thay vì tổng.
+    """
     print("🚀 Starting Ambient Email Agent Integration Tests\n")
     
-    tests = [
+    prerequisites = [
         ("Environment Setup", test_environment),
-        ("Service Imports", test_services),
+        ("Service Imports", lambda: test_services(_graph())),
+    ]
+    tests = [
         ("API Server", test_api_server),
         ("Email Processing", test_email_processing),
-        ("Graph Workflow", test_graph_workflow),
+        ("Graph Workflow", lambda: test_graph_workflow(_graph())),
         ("VIP Contacts", test_vip_contacts),
     ]
     
     passed = 0
-    total = len(tests)
+    total = len(prerequisites) + len(tests)
     
-    for test_name, test_func in tests:
-        print(f"\n{'='*50}")
-        print(f"Running: {test_name}")
-        print('='*50)
+    real_stdout = sys.stdout
+    sys.stdout = _ThreadStdout(real_stdout)
+    try:
+        for test_name, test_func in prerequisites:
+            ok, output = _run_test(test_name, test_func)
+            passed += ok
+            real_stdout.write(output)
         
-        try:
-            if test_func():
-                passed += 1
-                print(f"✅ {test_name} PASSED")
-            else:
-                print(f"❌ {test_name} FAILED")
-        except Exception as e:
-            print(f"❌ {test_name} FAILED with exception: {e}")
+        with ThreadPoolExecutor(max_workers=len(tests)) as ex:
+            futures = {ex.submit(_run_test, name, func): name for name, func in tests}
+            for fut in as_completed(futures):
+                ok, output = fut.result()
+                passed += ok
+                with print_lock:
+                    real_stdout.write(output)
+    finally:
+        sys.stdout = real_stdout
     
-    print(f"\n{'='*50}")
-    print(f"TEST SUMMARY: {passed}/{total} tests passed")
-    print('='*50)
-    
-    if passed == total:
-        print("🎉 All tests passed! The system is ready to use.")
-        return True
-    else:
-        print("⚠️ Some tests failed. Please check the errors above.")
-        return False
+    ok = passed == total
+    sys.stdout.write(summary_text(passed, total, ok))
+    return ok
+
+def summary_text(passed, total, ok):
+    """
+    Khối TEST SUMMARY, ghi ra bằng một lần write (runner ở trên và
+    pytest_terminal_summary trong conftest)
+    """
+    lines = [
+        f"\n{'='*50}",
+        f"TEST SUMMARY: {passed}/{total} tests passed",
+        '='*50,
+        "🎉 All tests passed! The system is ready to use." if ok
+        else "⚠️ Some tests failed. Please check the errors above.",
+    ]
+    return "\n".join(lines) + "\n"
 
 if __name__ == "__main__":
     # Load environment variables
     from dotenv import load_dotenv
     load_dotenv()
     
+    # Output của mỗi test đã được gom thành một write; tắt line buffering để
+    # stdout không flush từng dòng (khi chạy trên tty)
+    if hasattr(sys.stdout, "reconfigure"):
+        sys.stdout.reconfigure(line_buffering=False)
+    
+    # uvloop (cài sẵn qua uvicorn[standard], không có trên Windows) cho các asyncio.run trong tests
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    
+    # `--pytest`: để pytest chạy và báo lỗi (assert rewriting, traceback, fixtures
+    # trong conftest); mặc định dùng runner song song ở trên
+    if "--pytest" in sys.argv[1:]:
+        import pytest
+        sys.exit(pytest.main([__file__]))
+    
     success = run_all_tests()
     sys.exit(0 if success else 1)
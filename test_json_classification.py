@@ -3,69 +3,37 @@
 Test script to verify JSON-based email classification
 """
 
-import sys
-import os
-sys.path.append('src')
+# pytestmark và test_classify được import để pytest collect trong module này
+from _classify_harness import Case, pytestmark, run, test_classify  # noqa: F401
 
-from services.genai_service import classify_email
-
-def test_json_classification():
-    """Test the JSON-based email classification"""
-    
-    # Test cases
-    test_cases = [
-        {
-            "subject": "Meeting tomorrow at 2 PM",
-            "body": "Hi, can we schedule a meeting for tomorrow at 2 PM? Let me know if that works for you.",
-            "sender": "colleague@company.com",
-            "expected": "schedule"
-        },
-        {
-            "subject": "Please confirm the order",
-            "body": "Hi, I need you to confirm the order details before we proceed. Can you please reply?",
-            "sender": "client@customer.com", 
-            "expected": "needs_reply"
-        },
-        {
-            "subject": "Weekly Newsletter",
-            "body": "Here's our weekly newsletter with the latest updates and news.",
-            "sender": "newsletter@company.com",
-            "expected": "fyi"
-        },
-        {
-            "subject": "Win $1000 now!",
-            "body": "Congratulations! You've won $1000! Click here to claim your prize!",
-            "sender": "spam@fake.com",
-            "expected": "spam"
-        }
-    ]
-    
-    print("🧪 Testing JSON-based email classification...")
-    print("=" * 60)
-    
-    for i, test in enumerate(test_cases, 1):
-        print(f"\n📧 Test {i}: {test['subject']}")
-        print(f"From: {test['sender']}")
-        print(f"Expected: {test['expected']}")
-        
-        try:
-            result = classify_email(
-                test['subject'], 
-                test['body'], 
-                test['sender']
-            )
-            
-            status = "✅ PASS" if result == test['expected'] else "❌ FAIL"
-            print(f"Result: {result} {status}")
-            
-            if result != test['expected']:
-                print(f"Expected: {test['expected']}, Got: {result}")
-                
-        except Exception as e:
-            print(f"❌ ERROR: {e}")
-    
-    print("\n" + "=" * 60)
-    print("🎉 Test completed!")
+# Test cases: tạo một lần khi import module; dưới pytest mỗi case là một test
+# riêng (conftest parametrize test_classify theo CASES)
+CASES = (
+    Case(
+        'Meeting tomorrow at 2 PM',
+        'Hi, can we schedule a meeting for tomorrow at 2 PM? Let me know if that works for you.',
+        'colleague@company.com',
+        'schedule',
+    ),
+    Case(
+        'Please confirm the order',
+        'Hi, I need you to confirm the order details before we proceed. Can you please reply?',
+        'client@customer.com',
+        'needs_reply',
+    ),
+    Case(
+        'Weekly Newsletter',
+        "Here's our weekly newsletter with the latest updates and news.",
+        'newsletter@company.com',
+        'fyi',
+    ),
+    Case(
+        'Win $1000 now!',
+        "Congratulations! You've won $1000! Click here to claim your prize!",
+        'spam@fake.com',
+        'spam',
+    ),
+)
 
 if __name__ == "__main__":
-    test_json_classification()
+    run(CASES, "json_classification", "🧪 Testing JSON-based email classification...")
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Regression test cho genai_service.prepare_body (chuẩn hóa body trước khi vào prompt)
+
+Không gọi API.
+"""
+
+import sys
+
+def test_bare_dashes_separator_keeps_rest_of_body():
+    """Dòng "--" giữa body là separator, không phải signature delimiter"""
+    from src.services.genai_service import prepare_body
+    body = "Agenda:\n--\nBudget review\n--\nPlease confirm by Friday."
+    assert prepare_body(body) == "Agenda: -- Budget review -- Please confirm by Friday."
+    assert prepare_body("line\n--\nmore") == "line -- more"
+
+def test_signature_delimiter_cuts_signature():
+    from src.services.genai_service import prepare_body
+    assert prepare_body("Can we talk tomorrow?\n-- \nJohn Doe\nCEO, Example Inc.") == "Can we talk tomorrow?"
+
+def test_quoted_thread_is_dropped():
+    from src.services.genai_service import prepare_body
+    body = "Sounds good.\n> old line\nOn Mon, Jan 1, 2024 at 9:00 AM Bob wrote:\nolder thread"
+    assert prepare_body(body) == "Sounds good."
+
+if __name__ == "__main__":
+    tests = [v for k, v in list(globals().items()) if k.startswith("test_")]
+    failed = 0
+    for test in tests:
+        try:
+            test()
+            print(f"✅ {test.__name__}")
+        except AssertionError as e:
+            failed += 1
+            print(f"❌ {test.__name__}: {e}")
+    sys.exit(1 if failed else 0)
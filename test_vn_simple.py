@@ -3,57 +3,31 @@
 Test đơn giản cho email tiếng Việt
 """
 
-import os
-import sys
-# Add src to path
-sys.path.append('src')
+# pytestmark và test_classify được import để pytest collect trong module này
+from _classify_harness import Case, pytestmark, run, test_classify  # noqa: F401
 
-from services.genai_service import classify_email
-
-def test_vn_emails():
-    """Test một vài email tiếng Việt cơ bản"""
-    
-    test_cases = [
-        {
-            "subject": "Họp team tuần tới",
-            "body": "Chào mọi người, chúng ta có cuộc họp team vào thứ 3 tuần tới lúc 2h chiều.",
-            "sender": "manager@congty.com",
-            "expected": "schedule"
-        },
-        {
-            "subject": "Cần phản hồi gấp",
-            "body": "Dự án deadline sắp tới rồi. Anh có thể review và gửi feedback trước 5h chiều nay được không?",
-            "sender": "pm@congty.com",
-            "expected": "needs_reply"
-        },
-        {
-            "subject": "Chúc mừng! Bạn đã trúng thưởng!",
-            "body": "Chúc mừng! Bạn đã trúng 10 triệu đồng! Nhấn vào đây để nhận thưởng ngay!",
-            "sender": "lottery@fake.com",
-            "expected": "spam"
-        }
-    ]
-    
-    print("🇻🇳 Testing Vietnamese emails...")
-    print("=" * 50)
-    
-    for i, test in enumerate(test_cases, 1):
-        print(f"\n📧 Test {i}: {test['subject']}")
-        print(f"From: {test['sender']}")
-        print(f"Expected: {test['expected']}")
-        
-        try:
-            result = classify_email(
-                test['subject'], 
-                test['body'], 
-                test['sender']
-            )
-            status = "✅ PASS" if result == test['expected'] else "❌ FAIL"
-            print(f"Result: {result} {status}")
-        except Exception as e:
-            print(f"❌ ERROR: {e}")
-    
-    print("\n🎉 Test completed!")
+# Test cases: tạo một lần khi import module; dưới pytest mỗi case là một test
+# riêng (conftest parametrize test_classify theo CASES)
+CASES = (
+    Case(
+        'Họp team tuần tới',
+        'Chào mọi người, chúng ta có cuộc họp team vào thứ 3 tuần tới lúc 2h chiều.',
+        'manager@congty.com',
+        'schedule',
+    ),
+    Case(
+        'Cần phản hồi gấp',
+        'Dự án deadline sắp tới rồi. Anh có thể review và gửi feedback trước 5h chiều nay được không?',
+        'pm@congty.com',
+        'needs_reply',
+    ),
+    Case(
+        'Chúc mừng! Bạn đã trúng thưởng!',
+        'Chúc mừng! Bạn đã trúng 10 triệu đồng! Nhấn vào đây để nhận thưởng ngay!',
+        'lottery@fake.com',
+        'spam',
+    ),
+)
 
 if __name__ == "__main__":
-    test_vn_emails()
+    run(CASES, "vn_simple", "🇻🇳 Testing Vietnamese emails...")